@@ -0,0 +1,232 @@
+import numpy as np
+from multiprocessing import Process, Pipe
+import argparse
+import resource
+import platform
+import json
+import time
+import sys
+import knndata
+import knnes
+import knnpq
+import knnhpq
+import knnivf
+
+"""
+Benchmark of exact, PQ, HPQ and IVFPQ search on one dataset, reported as JSON:
+	build   : build time in seconds and the per-stage build timings of the index
+	latency : per-query latency percentiles (p50/p95/p99, milliseconds) of every search stage and of the whole search
+	qps     : queries per second searching one query at a time ('single') and in batches ('batch')
+	recall  : recall k@R, the fraction of the exact k nearest neighbours found among the first R results, for every R
+	memory  : bytes of the index structures, and the peak resident set size of the forked process the method ran in
+	          ('peak_rss', which includes the dataset and ground truth it inherits) and its increase over the
+	          resident set the process started with ('rss_increase', what the method itself took)
+Settings come from the defaults below, overridden by a JSON config file, overridden by the command line.
+"""
+
+CONFIG = {
+	'data'   : None,  # dataset file (see knndata); None generates N random D-dimensional vectors
+	'queries': None,  # query file; None generates nq random queries (or takes them from the end of data)
+	'N'      : 2**16,
+	'D'      : 64,
+	'nq'     : 1000,
+	'k'      : 10,
+	'R'      : [1, 10, 100],
+	'metric' : 'l2',
+	'methods': ['exact', 'pq', 'hpq', 'ivf'],
+	'M'      : 8,
+	'Kt'     : 256,
+	'alpha'  : 64,
+	'w'      : 8,
+	'nlist'  : 256,
+	'nprobe' : 8,
+	'rerank' : 0,
+	'kmcIter': 20,
+	'kmcSample': 2**16,
+	'batch'  : 256,
+	'seed'   : 7,
+}
+
+# latency percentiles in milliseconds of the latency samples lat (seconds)
+def percentiles(lat):
+	p = np.percentile(np.asarray(lat)*1e3, [50, 95, 99])
+	return {'p50': p[0], 'p95': p[1], 'p99': p[2]}
+
+# recall k@R of the returned ids I (nq,>=max(R)) against the exact k nearest neighbours G (nq,k)
+def recall(I, G, R):
+	return dict((str(r), np.mean([len(np.intersect1d(i[:r], g)) for i, g in zip(I, G)]) / float(G.shape[1])) for r in R)
+
+# peak resident set size of the process in bytes
+def peak_rss():
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1024, 1)[sys.platform == 'darwin']
+
+# current resident set size of the process in bytes (the peak where /proc is not available)
+def rss():
+	try:
+		with open('/proc/self/statm') as f:
+			return int(f.read().split()[1]) * resource.getpagesize()
+	except IOError:
+		return peak_rss()
+
+# index bytes of memory(), leaving out the dense indicator size that is reported for comparison only
+def index_bytes(index):
+	return int(sum(n for name, n in index.memory().items() if name != 'I_dense'))
+
+# time every stage (name, function of the query) of a one-query-at-a-time search over Q; the last stage
+# returns the result ids. returns the per-stage latency percentiles, the single-query QPS and the ids
+def single(Q, stages, n):
+	lat = dict((name, []) for name, _ in stages)
+	lat['search'] = []
+	ids = np.full((len(Q), n), -1, dtype=np.intp)
+	for q in range(len(Q)):
+		out = Q[q]
+		t0 = time.time()
+		for name, f in stages:
+			t = time.time()
+			out = f(q, out)
+			lat[name].append(time.time() - t)
+		lat['search'].append(time.time() - t0)
+		ids[q, :min(n, len(out))] = out[:n]
+	latency = dict((name, percentiles(l)) for name, l in lat.items())
+	return latency, len(Q) / sum(lat['search']), ids
+
+# queries per second of the batched search f(Qb) over Q in batches of batch queries
+def batched(Q, f, batch):
+	t = time.time()
+	for b in range(0, len(Q), batch):
+		f(Q[b:b+batch])
+	return len(Q) / (time.time() - t)
+
+# benchmark one method; returns its JSON result
+def bench(method, X, Q, G, cfg):
+	k, R, n = cfg['k'], cfg['R'], max(cfg['R'] + [cfg['k']])
+	res = {}
+	t = time.time()
+	if method == 'exact':
+		Yn = knnes.norms(X, cfg['metric']) if cfg['metric'] != 'ip' else None
+		res['build'] = {'time': time.time() - t}
+		res['latency'], qps, I = single(Q, [('search', lambda q, v: knnes.knn(X, v, n, cfg['metric'], Yn)[0][0])], n)
+		res['qps'] = {'single': qps, 'batch': batched(Q, lambda Qb: knnes.knn(X, Qb, n, cfg['metric'], Yn), cfg['batch'])}
+		res['memory'] = {'index': int(X.nbytes)}
+	elif method == 'pq':
+		index = knnpq.PQ(N=len(X), D=X.shape[1], M=cfg['M'], Kt=cfg['Kt'], dtype=X.dtype.type, readcsv=False, writecsv=False,
+		                 rtype=(None, X.dtype.type)[cfg['rerank'] > 0], metric=cfg['metric'])
+		index.construct(X, kmcIter=cfg['kmcIter'], kmcSeed=cfg['seed'], kmcSample=cfg['kmcSample'])
+		res['build'] = {'time': time.time() - t, 'stages': index.timings}
+		stages = [('lut', lambda q, v: index.lut(v)), ('scan', lambda q, Cd: index.scan(Cd, max(n, cfg['rerank']))[0])]
+		if cfg['rerank'] > 0:
+			stages.append(('rerank', lambda q, ids: index.rerank(Q[q], ids, n)[0]))
+		res['latency'], qps, I = single(Q, stages, n)
+		res['qps'] = {'single': qps, 'batch': batched(Q, lambda Qb: index.search_batch(Qb, n, rerank=cfg['rerank']), cfg['batch'])}
+		res['memory'] = {'index': index_bytes(index)}
+	elif method == 'hpq':
+		index = knnhpq.HPQ(N=len(X), D=X.shape[1], M=cfg['M'], Kt=cfg['Kt'], alpha=cfg['alpha'], dtype=X.dtype.type, readcsv=False, writecsv=False, metric=cfg['metric'])
+		index.construct(X, kmcIter=cfg['kmcIter'], kmcSeed=cfg['seed'], kmcSample=cfg['kmcSample'])
+		res['build'] = {'time': time.time() - t, 'levels': index.Nl}
+		w, H = cfg['w'], index.H
+		# the stages of HPQ.search: the lookup tables of every level, the scan of the top level, the descent
+		def top(q, Cd):
+			return Cd, index.pq[-1].scan(Cd[-1], (w, n)[H == 1])[0]
+		def descend(q, Cd_ids):
+			Cd, ids = Cd_ids
+			for i in range(H-2, -1, -1):
+				ids,_ = index.pq[i].scan(Cd[i], (w, n)[i == 0], index.children(i, ids))
+			return ids
+		res['latency'], qps, I = single(Q, [('lut', lambda q, v: [pq.lut(v) for pq in index.pq]), ('top', top), ('descend', descend)], n)
+		res['qps'] = {'single': qps, 'batch': batched(Q, lambda Qb: index.search_batch(Qb, n, cfg['w']), cfg['batch'])}
+		res['memory'] = {'index': index_bytes(index)}
+	elif method == 'ivf':
+		assert cfg['metric'] == 'l2', 'IVFPQ searches by l2 only'
+		index = knnivf.IVFPQ(N=len(X), D=X.shape[1], M=cfg['M'], Kt=cfg['Kt'], nlist=cfg['nlist'], dtype=X.dtype.type)
+		index.construct(X, kmcIter=cfg['kmcIter'], kmcSeed=cfg['seed'], kmcSample=cfg['kmcSample'])
+		res['build'] = {'time': time.time() - t, 'stages': index.pq.timings}
+		# the stages of IVFPQ.search: the nearest lists, the residual lookup tables, the scan of the lists
+		def probe(q, v):
+			return v, index.probe(v[np.newaxis], min(cfg['nprobe'], index.nlist))[0]
+		def lut(q, v_probes):
+			v, probes = v_probes
+			return index.pq.luts(v - index.Cq[probes]), probes
+		def scan(q, L_probes):
+			return index.scan(L_probes[0], L_probes[1], n)[0]
+		res['latency'], qps, I = single(Q, [('probe', probe), ('lut', lut), ('scan', scan)], n)
+		res['qps'] = {'single': qps, 'batch': batched(Q, lambda Qb: index.search_batch(Qb, n, cfg['nprobe']), cfg['batch'])}
+		res['memory'] = {'index': index_bytes(index)}
+	else:
+		assert False, 'unknown method '+method
+	res['recall'] = recall(I, G, R)
+	return res
+
+# run bench in a forked child process, so that its peak resident set is its own and not the largest of all
+# the methods run so far; the child inherits the dataset and ground truth without copying them
+def isolated(method, X, Q, G, cfg):
+	conn, child = Pipe()
+	def run():
+		base = rss()
+		try:
+			res = bench(method, X, Q, G, cfg)
+			res['memory']['peak_rss'] = peak_rss()
+			res['memory']['rss_increase'] = peak_rss() - base
+		except Exception as e:
+			res = e
+		child.send(res)
+	p = Process(target=run)
+	p.start()
+	res = conn.recv()
+	p.join()
+	if isinstance(res, Exception):
+		raise res
+	return res
+
+# the database and query vectors of the configuration
+def dataset(cfg):
+	if cfg['data'] is None:
+		X = knndata.synthetic(cfg['N'] + (cfg['nq'] if cfg['queries'] is None else 0), cfg['D'], seed=cfg['seed'])
+	else:
+		X = np.asarray(knndata.load(cfg['data'], mmap=True), dtype=np.float32)
+	if cfg['queries'] is None:
+		# the queries are held out from the end of the dataset
+		return X[:-cfg['nq']], X[-cfg['nq']:]
+	return X, np.asarray(knndata.load(cfg['queries']), dtype=np.float32)[:cfg['nq']]
+
+# run the benchmark of configuration cfg; returns the JSON report
+def run(cfg):
+	X, Q = dataset(cfg)
+	cfg = dict(cfg, N=len(X), D=X.shape[1], nq=len(Q))
+	t = time.time()
+	G,_ = knnes.knn(X, Q, cfg['k'], cfg['metric'])
+	report = {'config': cfg, 'groundtruth': {'time': time.time() - t},
+	          'system': {'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(), 'platform': platform.platform()},
+	          'results': {}}
+	for method in cfg['methods']:
+		report['results'][method] = isolated(method, X, Q, G, cfg)
+	return report
+
+# JSON encoder of NumPy scalars and arrays
+def tojson(o):
+	if isinstance(o, np.generic):
+		return o.item()
+	if isinstance(o, np.ndarray):
+		return o.tolist()
+	raise TypeError(repr(o)+' is not JSON serializable')
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Benchmark exact, PQ, HPQ and IVFPQ search; writes a JSON report')
+	parser.add_argument('--config', help='JSON file of settings overriding the defaults')
+	parser.add_argument('--out', help='report file; the report is printed when not given')
+	for name, value in sorted(CONFIG.items()):
+		if isinstance(value, list):
+			parser.add_argument('--'+name, nargs='+', type=type(value[0]))
+		else:
+			parser.add_argument('--'+name, type=type(value) if value is not None else str)
+	args = vars(parser.parse_args())
+	cfg = dict(CONFIG)
+	if args['config']:
+		with open(args['config']) as f:
+			cfg.update(json.load(f))
+	cfg.update((name, value) for name, value in args.items() if name in CONFIG and value is not None)
+	report = json.dumps(run(cfg), indent=1, sort_keys=True, default=tojson)
+	if args['out']:
+		with open(args['out'], 'w') as f:
+			f.write(report)
+	else:
+		print report
@@ -0,0 +1,109 @@
+import numpy as np
+import itertools
+import os
+
+"""
+Dataset files, chosen by extension:
+	.fvecs / .ivecs / .bvecs : vectors stored one after the other, each as its dimension d (int32, little endian)
+	                           followed by its d float32 / int32 / uint8 components (the TEXMEX ANN benchmark formats)
+	.npy                     : NumPy array file of an (N,D) array
+	.csv                     : text, one comma-separated vector per line
+Binary files are read, written and memory-mapped as whole NumPy arrays, never value by value.
+"""
+
+VECS  = {'.fvecs': '<f4', '.ivecs': '<i4', '.bvecs': 'u1'} # component type of every vecs format
+CHUNK = 2**16 # number of vectors per chunk when streaming or generating
+
+def _ext(fn):
+	return os.path.splitext(fn)[1].lower()
+
+# record type of a vecs file fn of D-dimensional vectors
+def _record(fn, D):
+	return np.dtype([('d', '<i4'), ('v', VECS[_ext(fn)], (D,))])
+
+# the vecs file fn mapped as an array of records, with mode 'r', 'r+' or 'c' (copy-on-write)
+def _vecs(fn, mode='r'):
+	D = int(np.fromfile(fn, dtype='<i4', count=1)[0])
+	rec = _record(fn, D)
+	size = os.path.getsize(fn)
+	assert size % rec.itemsize == 0, fn+' is not a '+_ext(fn)+' file of '+str(D)+'-dimensional vectors'
+	return np.memmap(fn, dtype=rec, mode=mode, shape=(size // rec.itemsize,))
+
+# the (N,D) vectors of the dataset file fn; mmap=True maps binary files read-only instead of reading them
+def load(fn, mmap=False):
+	ext = _ext(fn)
+	if ext == '.npy':
+		return np.load(fn, mmap_mode=('r', None)[not mmap])
+	if ext == '.csv':
+		return np.loadtxt(fn, delimiter=',', ndmin=2)
+	assert ext in VECS, 'unknown dataset format '+ext
+	recs = _vecs(fn)
+	if mmap:
+		return recs['v']
+	assert (recs['d'] == recs['d'][0]).all(), fn+' holds vectors of different dimensions'
+	return np.array(recs['v'])
+
+# create the dataset file fn for N D-dimensional vectors of type dtype (vecs files use the type of their format)
+# and return it as a writable (N,D) memory-mapped array to fill in
+def create(fn, N, D, dtype=np.float32):
+	ext = _ext(fn)
+	if ext == '.npy':
+		return np.lib.format.open_memmap(fn, mode='w+', dtype=dtype, shape=(N, D))
+	assert ext in VECS, 'cannot create '+ext+' files; use save'
+	recs = np.memmap(fn, dtype=_record(fn, D), mode='w+', shape=(N,))
+	recs['d'] = D
+	return recs['v']
+
+# write the vectors X, an (N,D) array or an iterator of (n_i,D) arrays, to the dataset file fn; returns N
+def save(fn, X, chunk=CHUNK):
+	ext = _ext(fn)
+	if isinstance(X, np.ndarray) and ext == '.csv':
+		np.savetxt(fn, X, delimiter=',')
+		return len(X)
+	if isinstance(X, np.ndarray) and ext == '.npy':
+		np.save(fn, X)
+		return len(X)
+	if isinstance(X, np.ndarray):
+		Y = X
+		X = (Y[b:b+chunk] for b in range(0, len(Y), chunk))
+	assert ext in VECS or ext == '.csv', 'streams are written to vecs or csv files'
+	N = 0
+	with open(fn, 'wb') as f:
+		for x in X:
+			x = np.asarray(x)
+			if ext == '.csv':
+				np.savetxt(f, x, delimiter=',')
+			else:
+				recs = np.empty((len(x)), dtype=_record(fn, x.shape[1]))
+				recs['d'] = x.shape[1]
+				recs['v'] = x
+				recs.tofile(f)
+			N += len(x)
+	return N
+
+# stream the vectors of the dataset file fn in chunks of at most chunk vectors, converted to dtype
+# binary files are mapped, so only the chunk being converted is read; e.g. knnpq.PQ.add(chunks(fn))
+def chunks(fn, chunk=CHUNK, dtype=np.float32):
+	if _ext(fn) == '.csv':
+		with open(fn) as f:
+			while True:
+				lines = list(itertools.islice(f, chunk))
+				if not lines:
+					return
+				yield np.loadtxt(lines, delimiter=',', ndmin=2).astype(dtype)
+	X = load(fn, mmap=True)
+	for b in range(0, len(X), chunk):
+		yield np.asarray(X[b:b+chunk], dtype=dtype)
+
+# N random D-dimensional vectors uniform in [0,1) of type dtype, generated chunk by chunk from seed
+# written straight into the dataset file fn (.npy or vecs) and returned memory-mapped when fn is given
+def synthetic(N, D, fn=None, dtype=np.float32, seed=7, chunk=CHUNK):
+	rs = np.random.RandomState(seed)
+	X = np.empty((N, D), dtype=dtype) if fn is None else create(fn, N, D, dtype)
+	for b in range(0, N, chunk):
+		x = rs.random_sample((min(chunk, N-b), D))
+		# integer vectors (ivecs / bvecs) span the range of their type
+		X[b:b+chunk] = x if np.issubdtype(X.dtype, np.floating) else x * (np.iinfo(X.dtype).max + 1.0)
+	if fn is not None:
+		X.flush()
+	return X
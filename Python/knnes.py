@@ -1,36 +1,85 @@
 import math
-import random
-import csv
 import operator
+import numpy as np
 
 # generate CSV file with random float numbers
 # N D-dimensional vectors splitted by 'delim' and written to csv file 'fn'
+# (binary datasets are faster to read and write, see knndata)
 def genRandCSV(N, D, delim, fn):
-	random.random()
-	row = []
-	with open(fn, 'w') as csvfile:
-		writer = csv.writer(csvfile, delimiter=delim)
-		for irow in range(N):
-			for icol in range(D):
-				row.append(random.random())
-			writer.writerow(row)
-			row=[];
-	csvfile.close()
+	np.savetxt(fn, np.random.random((N, D)), delimiter=delim)
 
 # read csv to matrix.
-# returns a 2d matrix
+# returns a 2d matrix (an (N,D) array)
 def CSV2Matrix(fn):
-	mat = []
-	with open(fn, 'rb') as csvfile:
-		lines = csv.reader(csvfile)
-		dataset = list(lines)
-		D = len(dataset[0])
-		N = len(dataset)
-		for x in range(N):
-			for y in range(D):
-				dataset[x][y] = float(dataset[x][y])
-			mat.append(dataset[x])
-	return mat
+	return np.loadtxt(fn, delimiter=',', ndmin=2)
+
+KNN_BLOCK  = 2**14 # number of database vectors per matrix product of the exact search
+KNN_QBLOCK = 2**10 # number of queries sharing one pass over the database
+
+# precomputed norms of the database vectors Y for metric: squared norms for 'l2', norms for 'cos' (unused by 'ip')
+def norms(Y, metric='l2'):
+	n = np.zeros((len(Y)), dtype=np.float32 if Y.dtype == np.float32 else np.float64)
+	for b in range(0, len(Y), KNN_BLOCK):
+		n[b:b+KNN_BLOCK] = np.einsum('nd,nd->n', Y[b:b+KNN_BLOCK], Y[b:b+KNN_BLOCK])
+	return n if metric == 'l2' else np.sqrt(n)
+
+# exact k-nearest neighbours of the query vectors Q (nq,D) in the database Y (N,D), sorted nearest first
+# metric 'l2' ranks by squared euclidean distance, 'ip' by negated inner product -q.y, 'cos' by cosine distance 1 - cosineSim.
+# distances of a block of queries to a block of the database are one matrix product with the precomputed
+# norms (pass norms(Y, metric) to reuse them), and every query keeps a running top-k across the blocks.
+# returns (nq,min(k,N)) ids and distances
+def knn(Y, Q, k, metric='l2', Yn=None):
+	assert metric in ('l2', 'ip', 'cos'), 'metric should be l2, ip or cos'
+	Q = np.atleast_2d(Q)
+	assert Q.shape[1] == Y.shape[1], 'query vectors should be as dimensional as the database vectors'
+	N = len(Y)
+	k = min(k, N)
+	if Yn is None and metric != 'ip':
+		Yn = norms(Y, metric)
+	dtype = np.float32 if Y.dtype == np.float32 else np.float64
+	ids   = np.zeros((len(Q), k), dtype=np.intp)
+	dists = np.zeros((len(Q), k), dtype=dtype)
+	for q in range(0, len(Q), KNN_QBLOCK):
+		Qb = np.asarray(Q[q:q+KNN_QBLOCK], dtype=dtype)
+		if metric == 'l2':
+			qn = np.einsum('nd,nd->n', Qb, Qb)[:, np.newaxis]
+		elif metric == 'cos':
+			qn = np.sqrt(np.einsum('nd,nd->n', Qb, Qb))[:, np.newaxis]
+			qn[qn == 0] = 1
+		I  = np.zeros((len(Qb), 0), dtype=np.intp)
+		Dd = np.zeros((len(Qb), 0), dtype=dtype)
+		for b in range(0, N, KNN_BLOCK):
+			d = np.dot(Qb, np.asarray(Y[b:b+KNN_BLOCK], dtype=dtype).T)
+			if metric == 'l2':
+				# ||q-y||^2 = ||q||^2 - 2 q.y + ||y||^2, clipped at 0 against rounding
+				d *= -2
+				d += Yn[b:b+KNN_BLOCK]
+				d += qn
+				np.maximum(d, 0, out=d)
+			elif metric == 'ip':
+				np.negative(d, out=d)
+			else:
+				yn = Yn[b:b+KNN_BLOCK].copy()
+				yn[yn == 0] = 1
+				d /= qn
+				d /= yn
+				np.subtract(1, d, out=d)
+			# the block's own top-k first, so only k ids and distances per query are merged into the running top-k
+			if d.shape[1] > k:
+				sel = np.argpartition(d, k-1, axis=1)[:, :k]
+				d = np.take_along_axis(d, sel, axis=1)
+			else:
+				sel = np.broadcast_to(np.arange(d.shape[1]), d.shape)
+			I  = np.concatenate((I , b + sel), axis=1)
+			Dd = np.concatenate((Dd, d), axis=1)
+			if Dd.shape[1] > k:
+				sel = np.argpartition(Dd, k-1, axis=1)[:, :k]
+				I  = np.take_along_axis(I , sel, axis=1)
+				Dd = np.take_along_axis(Dd, sel, axis=1)
+		order = np.argsort(Dd, axis=1, kind='mergesort')
+		ids  [q:q+KNN_QBLOCK] = np.take_along_axis(I , order, axis=1)
+		dists[q:q+KNN_QBLOCK] = np.take_along_axis(Dd, order, axis=1)
+	return ids, dists
 
 # computes euclidean distance between two equl-dimension vectors
 def euclideanDist(v1, v2):
@@ -51,7 +100,13 @@ def cosineSim(v1,v2):
 	return Sxy/math.sqrt(Sxx*Syy)
 
 # find k-nearest neighbours of qVec in the database vecDB using simFunc for compares
+# euclidean distances and cosine similarities are computed by knn, other simFuncs one vector at a time
+# cosineSim is a similarity, so its neighbours are the most similar vectors, not the least
 def KNN_ES(vecDB, qVec, k, simFunc):
+	if simFunc is euclideanDist or simFunc is cosineSim:
+		vecDB = np.asarray(vecDB)
+		ids,_ = knn(vecDB, qVec, k, ('l2', 'cos')[simFunc is cosineSim])
+		return list(vecDB[ids[0]])
 	dists = []
 	D = len(qVec)
 	N = len(vecDB)
@@ -80,5 +135,6 @@ def main():
 		for j in range(k):
 			print repr(neighbors[j])
 		print
-	
-main()
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,53 @@
+import numpy as np
+from multiprocessing.pool import ThreadPool
+import multiprocessing
+import time
+
+"""
+Concurrent query executor over a constructed index (knnpq.PQ, knnhpq.HPQ or knnivf.IVFPQ).
+Searches keep all per-query state (lookup tables, block buffers, running top-k) in local arrays and
+only read the index, so any number of threads can search one index at once; their inner kernels
+(matrix products, gathers, sums, argpartition) are NumPy calls that release the GIL while they run.
+"""
+
+QUERY_CHUNK = 2**5 # number of queries per task handed to a pool thread
+
+class QueryExecutor(object):
+
+	# initialize the executor with a thread pool of workers threads (default: one per core)
+	def __init__(self, index, workers=None, chunk=QUERY_CHUNK):
+		self.index = index
+		self.workers = workers if workers is not None else multiprocessing.cpu_count()
+		self.chunk = chunk
+		self.pool = ThreadPool(self.workers)
+
+	# batched search of the query vectors Q (nq,D), fanned out over the pool in chunks of queries
+	# extra keyword arguments go to the index's search_batch (e.g. rerank, w, nprobe)
+	# returns (nq,k) ids and distances, as the index's search_batch does
+	def search_batch(self, Q, k, **kwargs):
+		Q = np.asarray(Q)
+		chunks = [Q[q:q+self.chunk] for q in range(0, len(Q), self.chunk)]
+		results = self.pool.map(lambda Qc: self.index.search_batch(Qc, k, **kwargs), chunks)
+		return np.concatenate([r[0] for r in results]), np.concatenate([r[1] for r in results])
+
+	# run one query asynchronously; returns a result whose get() gives the index's search(qvec, k, ...) result
+	def submit(self, qvec, k, **kwargs):
+		return self.pool.apply_async(self.index.search, (qvec, k), kwargs)
+
+	# queries per second of search_batch over Q, timed over repeat runs
+	def qps(self, Q, k, repeat=1, **kwargs):
+		t = time.time()
+		for r in range(repeat):
+			self.search_batch(Q, k, **kwargs)
+		return repeat * len(Q) / (time.time() - t)
+
+	def close(self):
+		self.pool.close()
+		self.pool.join()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+		return False
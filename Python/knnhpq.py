@@ -1,16 +1,6 @@
 import numpy as np
-from scipy.cluster.vq import vq, kmeans2
-from datetime import datetime
-import time
-import random
-import math
-import operator
 import knnpq
-
-from mpl_toolkits.mplot3d import Axes3D
-import matplotlib
-matplotlib.use('Agg') # prevents interactive plots
-import matplotlib.pyplot as plt
+import knnstore
 
 """
 N : Database size
@@ -25,242 +15,166 @@ C : codebook
 	Cn: number of point attched to the centroid
 	Cd: distances between centroid and a query
 Yt : encoded dataset Y; the set of vector indecies assigned to the sub-codeword in C
+H  : the number of levels; level 0 is the database, level i+1 holds the k-means centroids of level i
+w  : beam width, the number of nodes kept per level while descending the hierarchy
+metric: distance ranked by the search, 'l2', 'ip' or 'cos' (see knnpq.METRICS); the levels are clustered by
+	euclidean k-means in every metric, of the normalized vectors for cos
 """
 
 class HPQ(object):
 
-	# initialize PQ class
-	def __init__(self, N, D, M, Kt, alpha=64, dtype=np.float32, readcsv=True, writecsv=True, verbose=False, plot=False, dump=False):
+	# initialize HPQ class
+	# levels are added until the top one holds at most alpha vectors; level i holds N/alpha**i vectors
+	def __init__(self, N, D, M, Kt, alpha=64, dtype=np.float32, readcsv=True, writecsv=True, verbose=False, plot=False, dump=False, metric='l2'):
 		# parameter checks
 		assert D % M == 0, 'equally divided sub-spaces are required; make sure M divides D'
 		assert Kt <= N, 'Kt, the number of sub-codewords in each subspace, should be smaller than the number of the database vectors'
 		assert 0 < Kt <= 2 ** 32, 'codebook should be smaller than 2**32'
-		assert 0 < alpha, 'tappering factor should be a positive number'
+		assert 1 < alpha, 'tappering factor should be larger than one'
+		assert metric in knnpq.METRICS, 'metric should be one of '+', '.join(knnpq.METRICS)
 		# assign parameters
 		self.N = N
 		self.D = D
 		self.M = M
 		self.Dt = D/M
 		self.Kt = Kt
-		self.H  = int(math.ceil(math.log(2048,2)/math.log(32,2)))
-
-		# code index type, based on the codebook length 'Kt'
-		self.ctype = ((np.uint32,np.uint16)[Kt<=2**16],np.uint8)[Kt<=2**8]
+		self.alpha = alpha
+		self.metric = metric
 
-		# data index type, based on the length 'N'
-		self.itype = ((np.uint32,np.uint16)[N<=2**16],np.uint8)[N<=2**8]
+		# number of levels and the number of vectors in each
+		self.Nl = [N]
+		while self.Nl[-1] > alpha:
+			self.Nl.append(self.Nl[-1] / alpha)
+		self.H = len(self.Nl)
 
 		# data type
 		self.dtype = dtype
 
-		# C: create 3d matrix of centroid codes: [M subspaces][Kt codewords][Dt dim of subspace] centroids codebook
-		#self.Cc  = np.zeros((self.M, self.Kt, self.Dt), dtype=self.dtype) 
-		#self.Cn = np.zeros((self.M, self.Kt         ), dtype=self.itype) # number of points attached to each centroid
-		#self.Cd = np.zeros((self.M, self.Kt         ), dtype=self.dtype) # distances between sub-query vector and each centroid
-
-		# Yt: create 2d matrix of code index per sub-vector: [M subspaces][N vectors] encoded input vectors
-		#self.Yt = np.zeros((self.N, self.M        ), dtype=self.ctype )
-
-		# create 3d matrix of code indicators per sub-vector: [M subspaces][k codewords][N vector addresses]
-		self.I = np.zeros((self.M, self.Kt, self.N), dtype=np.uint8 )
-
-		self.Y  = []
-		self.pq = []
-		self.Yt = []
+		self.Y  = [] # vectors of each level: the database, then the centroids of the level below
+		self.pq = [] # PQ of each level
+		self.Yt = [] # Yt[i]: the node of level i+1 each vector of level i is assigned to
+		# children of each node in CSR layout: the level i vectors assigned to node j of level i+1 are Ci[i][Co[i][j] : Co[i][j+1]]
+		self.Co = []
+		self.Ci = []
 
 		self.readcsv = readcsv
 		self.writecsv = writecsv
 		self.verbose = verbose
 		self.plot = plot
 		if verbose:
-			print 'PQ class parameters: N:',N,', D:',D,', M:',M,', Dt:',self.Dt,', Kt: ',Kt,', ctype:',self.ctype
+			print 'HPQ class parameters: N:',N,', D:',D,', M:',M,', Dt:',self.Dt,', Kt: ',Kt,', alpha:',alpha,', H:',self.H,', levels:',self.Nl
 
 	##########################################
 
-	# construct the PQ databased
-	def construct(self, Y, kmcIter=20,kmcSeed=7):
+	# construct the HPQ database: a PQ per level, each level built from the k-means centroids of the level below
+	# kmcSample / kmcBatch train every k-means on a sample / with mini-batches of that many vectors (see knnpq.kmeans)
+	# workers / pool train the subspaces of each level's PQ concurrently (see knnpq.PQ.construct)
+	def construct(self, Y, kmcIter=20,kmcSeed=7, kmcSample=None, kmcBatch=None, workers=1, pool='process'):
 		# checks on vectors DB
 		assert Y.ndim     == 2         , 'Vectors database should be a two dimensional matrix'
 		assert Y.shape[0] == self.N    , 'Vectors database should have N vectors'
 		assert Y.shape[1] == self.D    , 'Vectors in database should be D-dimensional'
 		assert Y.dtype    == self.dtype, 'Vector type should be self.dtype'
 
-		w=8
-		self.Y.append(Y)
-
-		for i in range(self.H):	
-			self.pq.append(knnpq.PQ(N=self.N/(alpha**i), D=self.D, M=self.M, Kt=self.Kt, dtype=self.dtype, readcsv=False, writecsv=False, verbose=True, plot=False, dump=True))
-			self.pq[i].construct(Y[i],kmcIter=20,kmcSeed=seed)
-			if i < H-1:
-				Cc_ = np.zeros((self.Kt,self.D), dtype=dtype    ) 
-				Yt_ = np.zeros((self.N/(alpha**i)), dtype=np.uint16)
-				Cc_, Yt_ = kmeans2(Y[i], self.N/(alpha**(i+1)), iter=20, minit='points')
+		if self.metric == 'cos':
+			Y = knnpq.normalize(Y)
+		self.Y  = [Y]
+		self.pq = []
+		self.Yt = []
+		self.Co = []
+		self.Ci = []
+		for i in range(self.H):
+			if i > 0:
+				if self.verbose:
+					print 'k-means clustering of level',i-1,'into',self.Nl[i],'centroids'
+				# centroids of the level below and the assignment of its vectors to them
+				Cc_ = knnpq.kmeans(self.Y[i-1], self.Nl[i], iter=kmcIter, seed=kmcSeed, sample=kmcSample, batch=kmcBatch).astype(self.dtype)
+				Yt_,_ = knnpq.assign(self.Y[i-1], Cc_)
 				self.Y.append(Cc_)
-
-		return self
-
-	# vectors batch quantization
-	def qvec_(self, vecs):
-		# checks on vectors DB
-		assert vecs.ndim     == 2         , 'Vectors database should be a two dimensional matrix'
-		assert vecs.shape[1] == self.D    , 'Vectors in database should be D-dimensional'
-		assert vecs.dtype    == self.dtype, 'Vector type should be self.dtype'
-		Nq = vecs.shape[0] # number of query vectors
-		# qcodes[n][m] : code of n-th vec, m-th subspace
-		qcodes = np.empty((Nq, self.M), dtype=self.ctype)
-		for m in range(self.M):
+				self.Yt.append(Yt_.astype(np.uint32))
+				self.Ci.append(np.argsort(Yt_, kind='mergesort').astype(np.uint32))
+				self.Co.append(np.concatenate(([0], np.cumsum(np.bincount(Yt_, minlength=self.Nl[i])))))
 			if self.verbose:
-				print("Encoding the subspace: {} / {}".format(m, self.M))
-			vecs_sub = vecs[:, m * self.Dt : (m+1) * self.Dt]
-			qcodes[:, m], _ = vq(vecs_sub, self.codewords[m])
-		return qcodes
-
-	# update distances based on query vector
-	def udist(self, qvec):
-		for m in range(self.M):
-			for k in range(self.Kt):
-				qvec_sub = qvec[m*self.Dt : (m+1)*self.Dt]
-				self.Cd[m,k]= self.euclideanDistSqr(self.Cc[m,k],qvec_sub)
+				print 'PQ of level',i,'/',self.H
+			self.pq.append(knnpq.PQ(N=self.Nl[i], D=self.D, M=self.M, Kt=min(self.Kt, self.Nl[i]), dtype=self.dtype, readcsv=False, writecsv=self.writecsv and i == 0, verbose=self.verbose, plot=False, dump=True, metric=self.metric))
+			self.pq[i].construct(self.Y[i], kmcIter=kmcIter, kmcSeed=kmcSeed, kmcSample=kmcSample, kmcBatch=kmcBatch, workers=workers, pool=pool)
 		return self
 
-	def prune(self, qvec):
-		self.udist(qvec)
-		mini = 0
-		mina = [self.Cd[m,self.Yt[mini,m]] for m in range(self.M)]
-		mind = sum(mina)
-		pruned=0
-		for n in range(1,self.N):
-			cura = [self.Cd[m,self.Yt[n,m]] for m in range(self.M)]
-			curd = sum(cura)
-			if np.all(np.greater_equal(cura,mina)):
-				pruned+=1
-			if (curd<mind):
-				mini=n
-				mina=cura
-				mind=curd
-		return pruned
-				
-	def pruneMulti(self, qvec, k):
-		self.udist(qvec)
-		mini = np.zeros((k       ), dtype=self.itype)
-		mina = np.zeros((k,self.M), dtype=self.dtype)
-		mind = np.zeros((k       ), dtype=self.dtype)
-		for ki in range(k):
-			mini[ki] = ki
-			mina[ki] = [self.Cd[m,self.Yt[mini[ki],m]] for m in range(self.M)]
-			mind[ki] = sum(mina[ki])
-		pruned=0
-		for n in range(k,self.N):
-			cura = [self.Cd[m,self.Yt[n,m]] for m in range(self.M)]
-			curd = sum(cura)
-			if np.any([np.all(np.greater_equal(cura,mina[ki])) for ki in range(k)]):
-				pruned+=1
-			maxi=np.argmax(mind)
-			if (curd<mind[maxi]):
-				mini[maxi]=n
-				mina[maxi]=cura
-				mind[maxi]=curd
-		return pruned
-
-	# KNN-PQ-ES query
-	def knnpqes(self, qvec, k):
-		dist = np.zeros((self.N), dtype=self.dtype)
-		#dSum = np.zeros((self.N), dtype=self.dtype)
-		self.udist(qvec)
-		for n in range(self.N):
-		#	for m in range(self.M):
-		#		dist[n] += self.Cd[m,self.Yt[n,m]]
-			dist[n] = sum([self.Cd[m,self.Yt[n,m]] for m in range(self.M)])
-		kmax = dist.argsort()[:k]
+	# level i vectors that are children of the level i+1 nodes in ids
+	def children(self, i, ids):
+		Co, Ci = self.Co[i], self.Ci[i]
+		return np.concatenate([Ci[Co[j]:Co[j+1]] for j in ids] + [np.zeros((0), dtype=Ci.dtype)])
+
+	# KNN-HPQ beam search: scan the top level, then descend one level at a time keeping the w nearest
+	# nodes and scanning only their children; returns the ids of the k nearest vectors and their approximate distances
+	def search(self, qvec, k, w=8):
+		Cd = [pq.lut(qvec) for pq in self.pq]
+		ids, dists = self.pq[-1].scan(Cd[-1], (w, k)[self.H == 1])
+		for i in range(self.H-2, -1, -1):
+			ids, dists = self.pq[i].scan(Cd[i], (w, k)[i == 0], self.children(i, ids))
+		return ids, dists
+
+	# batched KNN-HPQ beam search of the query vectors Q (nq,D); the top levels of all queries are scanned
+	# together, the descent is per query. returns (nq,k) ids and approximate distances, padded with -1 / inf
+	def search_batch(self, Q, k, w=8):
+		Q = np.asarray(Q, dtype=self.dtype)
+		L = [pq.luts(Q) for pq in self.pq]
+		top, topd = self.pq[-1].scan_batch(L[-1], (w, k)[self.H == 1])
+		ids   = np.full((len(Q), k), -1    , dtype=np.intp  )
+		dists = np.full((len(Q), k), np.inf, dtype=self.dtype)
+		for q in range(len(Q)):
+			qids, qdists = top[q], topd[q]
+			for i in range(self.H-2, -1, -1):
+				qids, qdists = self.pq[i].scan(L[i][q], (w, k)[i == 0], self.children(i, qids))
+			ids[q, :len(qids)], dists[q, :len(qids)] = qids[:k], qdists[:k]
+		return ids, dists
+
+	# KNN-HPQ query
+	def knnhpq(self, qvec, k, w=8):
+		kmax,_ = self.search(qvec, k, w)
 		return kmax
 
-	# KNN-PQ-ES query / selective search indices
-	def knnpqes_sel(self, qvec, k, sidx):
-		dist = np.full((self.N), np.finfo(self.dtype).max, self.dtype)
-		#dSum = np.zeros((self.N), dtype=self.dtype)
-		self.udist(qvec)
-		for n in sidx:
-		#	for m in range(self.M):
-		#		dist[n] += self.Cd[m,self.Yt[n,m]]
-			dist[n] = sum([self.Cd[m,self.Yt[n,m]] for m in range(self.M)])
-		kmax = dist.argsort()[:k]
-		return kmax
-
-	#def knnhpq(self, qvec, k):
-
-
-	def update(self, uvec, uidx):
-		for m in range(self.M):
-			uvec_sub = uvec[m*self.Dt : (m+1)*self.Dt]
-			cid,_,_ = self.knnes(self.Cc[m],uvec_sub,1,self.euclideanDistSqr)
-			self.I[m,self.Yt[uidx,m],uidx]=0
-			self.Yt[uidx,m]=cid
-			self.I[m,cid,uidx]=1
+	# memory footprint of the index structures in bytes, summed over the levels
+	def memory(self):
+		mem = {}
+		for pq in self.pq:
+			for name, n in pq.memory().items():
+				mem[name] = mem.get(name, 0) + n
+		mem['tree'] = sum(a.nbytes for a in self.Yt + self.Co + self.Ci)
+		return mem
+
+	# save the index to the binary index file fn (see knnstore): the PQ of every level, the centroids
+	# of the levels above the database, the assignment of every level's vectors to the level above and the child lists
+	def save(self, fn):
+		params = {'N': self.N, 'D': self.D, 'M': self.M, 'Kt': self.Kt, 'alpha': self.alpha, 'H': self.H, 'dtype': np.dtype(self.dtype).name, 'metric': self.metric, 'pq': []}
+		arrays = {}
+		for i in range(self.H):
+			params['pq'].append(self.pq[i].params())
+			if self.pq[i].Istale:
+				self.pq[i].ilists()
+			for name, a in self.pq[i].arrays().items():
+				arrays['pq'+str(i)+'.'+name] = a
+		for i in range(self.H-1):
+			arrays['Y' +str(i+1)] = self.Y[i+1]
+			arrays['Yt'+str(i)] = self.Yt[i]
+			arrays['Co'+str(i)] = self.Co[i]
+			arrays['Ci'+str(i)] = self.Ci[i]
+		knnstore.save(fn, 'HPQ', params, arrays)
 		return self
 
-	def query(self, qvec, k, kc):
-		indcs = np.zeros((self.M, kc, self.N), dtype=np.uint8  )
-		indcs_ = np.zeros((self.M, kc, self.N), dtype=self.dtype)
-		cid   = np.zeros((self.M, kc        ), dtype=self.ctype)
-		dists = np.zeros((self.M, kc        ), dtype=self.dtype)
-		inf = 2
-		for m in range(self.M):
-			qvec_sub = qvec[m*self.Dt : (m+1)*self.Dt]
-			cid[m],_,dists[m] = self.knnes(self.Cc[m],qvec_sub,kc,self.euclideanDistSqr)
-			indcs[m][:] = self.I[m][cid[m][:]]
-			for kci in range(kc):
-				indcs_[m][kci] = self.I[m][cid[m][kci]]*dists[m][kci]
-		indcs_[indcs_==0] = inf
-		iOR = np.zeros((self.M,self.N), dtype=np.uint8)
-		iOR = np.min(indcs_,axis=1)
-		iSum = np.zeros((self.N), dtype=np.uint8)
-		iSum = np.sum(iOR,axis=0)
-		#kmax = iSum.argsort()[-k:][::-1]
-		kmax = iSum.argsort()[:k]
-		return indcs, indcs_, dists, iOR, iSum, kmax
-
-	# KNN-ES
-	# find k-nearest neighbours of qVec in the database Y using simFunc for compares
-	def knnes(self, Y, qVec, k, simFunc):
-		vInfo = []
-		D = len(qVec)
-		N = len(Y)
-		for i in range(N):
-			dist = simFunc(qVec, Y[i])
-			vInfo.append((i, Y[i], dist))
-		vInfo.sort(key=operator.itemgetter(2))
-		#neighbors = []
-		ids       = np.zeros((k   ), dtype=np.uint32 )
-		neighbors = np.zeros((k, D), dtype=self.dtype)
-		dists     = np.zeros((k   ), dtype=self.dtype)
-		for i in range(k):
-			ids[i]       = vInfo[i][0]
-			neighbors[i] = vInfo[i][1]
-			dists[i]     = vInfo[i][2]
-		return ids, neighbors, dists
-
-	# computes euclidean distance between two equl-dimension vectors
-	def euclideanDist(self,v1, v2):
-		# compute euclidean distance
-		dist = 0
-		for i in range(len(v1)):
-			dist += pow((v1[i] - v2[i]), 2)
-		return math.sqrt(dist)
-
-	def euclideanDistSqr(self,v1, v2):
-		# compute euclidean distance
-		dist = 0
-		for i in range(len(v1)):
-			dist += pow((v1[i] - v2[i]), 2)
-		return dist
-
-	# compute cosine similarity of two equl-dimension vectors v1 to v2
-	# COSSIM = (v1 dot v2)/(||v1||*||v2||)
-	def cosineSim(self,v1,v2):
-		Sxx, Sxy, Syy = 0, 0, 0
-		for i in range(len(v1)):
-			Sxx += v1[i]*v1[i]
-			Syy += v2[i]*v2[i]
-			Sxy += v1[i]*v2[i]
-		return Sxy/math.sqrt(Sxx*Syy)
-
+	# load an index saved by save(); mmap='r' maps the arrays from the file instead of reading them
+	# the database vectors themselves are not part of the index, so Y[0] is None
+	@classmethod
+	def load(cls, fn, mmap=None, verbose=False):
+		name, params, arrays = knnstore.load(fn, mmap)
+		assert name == 'HPQ', fn+' holds a '+name+' index, not an HPQ index'
+		hpq = cls(N=params['N'], D=params['D'], M=params['M'], Kt=params['Kt'], alpha=params['alpha'], dtype=np.dtype(str(params['dtype'])).type, readcsv=False, writecsv=False, verbose=verbose, metric=str(params.get('metric', 'l2')))
+		assert hpq.H == params['H'], 'level count does not match the index parameters'
+		for i in range(hpq.H):
+			prefix = 'pq'+str(i)+'.'
+			hpq.pq.append(knnpq.PQ.fromarrays(params['pq'][i], dict((n[len(prefix):], a) for n, a in arrays.items() if n.startswith(prefix)), verbose=verbose))
+		hpq.Y  = [None] + [arrays['Y' +str(i+1)] for i in range(hpq.H-1)]
+		hpq.Yt = [arrays['Yt'+str(i)] for i in range(hpq.H-1)]
+		hpq.Co = [arrays['Co'+str(i)] for i in range(hpq.H-1)]
+		hpq.Ci = [arrays['Ci'+str(i)] for i in range(hpq.H-1)]
+		return hpq
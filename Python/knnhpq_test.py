@@ -106,17 +106,14 @@ for lK in lK_list:
 		#print neighbors_
 		#print 'dists_'
 		#print dists_
-		match = []
-		for i in range(pq[0].N):
-			for j in range(w):
-				if Yt_[i] == ids_[j]:
-					match.append(i)
+		# vectors whose coarse centroid is one of the w probed ones (see knnivf.IVFPQ for the indexed version)
+		match = np.flatnonzero(np.in1d(Yt_, ids_))
 		#print 'match:'
 		#print len(match)
 		#print match
 
 ###########
-		ids, neighbors, dists = pq[0].knnes(Y[0],qV[qi],pq[0].N,pq[0].euclideanDistSqr);
+		ids, neighbors, dists = pq[0].knnes(Y[0],qV[qi],max(R),pq[0].euclideanDistSqr);
 		#print 'neighbors:',ids,'-',neighbors,'-',dists
 		#for ii in range(10):
 			#print 'ids[:ii*10]-',ii+1,ids[:ii*10+10]
@@ -0,0 +1,148 @@
+import numpy as np
+import knnpq
+import knnstore
+
+"""
+N : Database size
+D : Space dimension
+M : the number of subspaces (subquantizers)
+Kt: the number of sub-codewords in each subspace
+nlist : the number of coarse centroids (inverted lists)
+nprobe: the number of inverted lists visited per query
+Cq: coarse centroids
+Lo, Li : inverted lists in CSR layout; the ids of the vectors assigned to coarse centroid c are Li[Lo[c] : Lo[c+1]], sorted
+pq: PQ of the residuals Y - Cq[coarse centroid of Y]
+"""
+
+class IVFPQ(object):
+
+	# initialize IVFPQ class
+	def __init__(self, N, D, M, Kt, nlist, dtype=np.float32, verbose=False):
+		# parameter checks
+		assert 0 < nlist <= N, 'nlist, the number of inverted lists, should be smaller than the number of the database vectors'
+		# assign parameters
+		self.N = N
+		self.D = D
+		self.M = M
+		self.Kt = Kt
+		self.nlist = nlist
+
+		# data type
+		self.dtype = dtype
+
+		self.Cq = np.zeros((nlist, D  ), dtype=dtype    )
+		self.Lo = np.zeros((nlist+1   ), dtype=np.int64 )
+		self.Li = np.zeros((N         ), dtype=np.uint32)
+		self.pq = knnpq.PQ(N=N, D=D, M=M, Kt=Kt, dtype=dtype, readcsv=False, writecsv=False, verbose=verbose)
+
+		self.verbose = verbose
+		if verbose:
+			print 'IVFPQ class parameters: N:',N,', D:',D,', M:',M,', Kt:',Kt,', nlist:',nlist
+
+	##########################################
+
+	# construct the IVFPQ database: coarse k-means, inverted lists and the PQ of the residuals
+	# kmcSample / kmcBatch train the coarse quantizer on a sample / with mini-batches of that many vectors (see knnpq.kmeans);
+	# the remaining arguments are passed to the residual PQ (see knnpq.PQ.construct)
+	def construct(self, Y, kmcIter=20,kmcSeed=7, kmcSample=None, kmcBatch=None, workers=1, pool='process'):
+		# checks on vectors DB
+		assert Y.ndim     == 2         , 'Vectors database should be a two dimensional matrix'
+		assert Y.shape[0] == self.N    , 'Vectors database should have N vectors'
+		assert Y.shape[1] == self.D    , 'Vectors in database should be D-dimensional'
+		assert Y.dtype    == self.dtype, 'Vector type should be self.dtype'
+
+		if self.verbose:
+			print 'k-means clustering of the coarse quantizer into',self.nlist,'centroids'
+		self.Cq[:] = knnpq.kmeans(Y, self.nlist, iter=kmcIter, seed=kmcSeed, sample=kmcSample, batch=kmcBatch)
+		labels,_ = knnpq.assign(Y, self.Cq)
+		self.Li[:] = np.argsort(labels, kind='mergesort')
+		self.Lo[1:] = np.cumsum(np.bincount(labels, minlength=self.nlist))
+
+		# residuals of the vectors to their coarse centroids
+		R = Y - self.Cq[labels]
+		self.pq.construct(R, kmcIter=kmcIter, kmcSeed=kmcSeed, kmcSample=kmcSample, kmcBatch=kmcBatch, workers=workers, pool=pool)
+		return self
+
+	# ids of the vectors in inverted list c
+	def ilist(self, c):
+		return self.Li[self.Lo[c] : self.Lo[c+1]]
+
+	# the nprobe nearest coarse centroids of each query vector in Q (nq,D), nearest first
+	def probe(self, Q, nprobe):
+		d = np.dot(Q, self.Cq.T)
+		d *= -2
+		d += np.einsum('cd,cd->c', self.Cq, self.Cq)
+		sel = knnpq.topk(d, nprobe)
+		order = np.take_along_axis(d, sel, axis=1).argsort(axis=1)
+		return np.take_along_axis(sel, order, axis=1)
+
+	# scan the probed lists of one query vector with the residual lookup tables L (nprobe,M,Kt)
+	def scan(self, L, probes, k):
+		ids   = []
+		dists = []
+		for c, Cd in zip(probes, L):
+			if self.Lo[c+1] > self.Lo[c]:
+				i, d = self.pq.scan(Cd, k, self.ilist(c))
+				ids.append(i)
+				dists.append(d)
+		if not ids:
+			return np.zeros((0), dtype=np.intp), np.zeros((0), dtype=self.dtype)
+		ids, dists = np.concatenate(ids), np.concatenate(dists)
+		sel = knnpq.topk(dists, k)
+		order = dists[sel].argsort()
+		return ids[sel][order], dists[sel][order]
+
+	# KNN-IVFPQ search: visit only the nprobe inverted lists nearest to qvec, scoring their vectors with the
+	# lookup table of the query residual to each list's centroid; returns ids and approximate distances
+	def search(self, qvec, k, nprobe=8):
+		qvec = np.asarray(qvec, dtype=self.dtype)
+		probes = self.probe(qvec[np.newaxis], min(nprobe, self.nlist))[0]
+		return self.scan(self.pq.luts(qvec - self.Cq[probes]), probes, k)
+
+	# batched KNN-IVFPQ search of the query vectors Q (nq,D); returns (nq,k) ids and approximate distances,
+	# padded with -1 / inf when the probed lists hold fewer than k vectors
+	def search_batch(self, Q, k, nprobe=8):
+		Q = np.asarray(Q, dtype=self.dtype)
+		nprobe = min(nprobe, self.nlist)
+		probes = self.probe(Q, nprobe)
+		# residual lookup tables of every (query, probed list) pair in one batch
+		L = self.pq.luts((Q[:, np.newaxis, :] - self.Cq[probes]).reshape(-1, self.D)).reshape(len(Q), nprobe, self.M, -1)
+		ids   = np.full((len(Q), k), -1    , dtype=np.intp  )
+		dists = np.full((len(Q), k), np.inf, dtype=self.dtype)
+		for q in range(len(Q)):
+			qids, qdists = self.scan(L[q], probes[q], k)
+			ids[q, :len(qids)], dists[q, :len(qids)] = qids, qdists
+		return ids, dists
+
+	# KNN-IVFPQ query
+	def knnivfpq(self, qvec, k, nprobe=8):
+		kmax,_ = self.search(qvec, k, nprobe)
+		return kmax
+
+	# memory footprint of the index structures in bytes
+	def memory(self):
+		mem = self.pq.memory()
+		mem['Cq'] = self.Cq.nbytes
+		mem['L']  = self.Lo.nbytes + self.Li.nbytes
+		return mem
+
+	# save the index to the binary index file fn (see knnstore)
+	def save(self, fn):
+		if self.pq.Istale:
+			self.pq.ilists()
+		params = {'N': self.N, 'D': self.D, 'M': self.M, 'Kt': self.Kt, 'nlist': self.nlist, 'dtype': np.dtype(self.dtype).name, 'pq': self.pq.params()}
+		arrays = {'Cq': self.Cq, 'Lo': self.Lo, 'Li': self.Li}
+		for name, a in self.pq.arrays().items():
+			arrays['pq.'+name] = a
+		knnstore.save(fn, 'IVFPQ', params, arrays)
+		return self
+
+	# load an index saved by save(); mmap='r' maps the arrays from the file instead of reading them
+	@classmethod
+	def load(cls, fn, mmap=None, verbose=False):
+		name, params, arrays = knnstore.load(fn, mmap)
+		assert name == 'IVFPQ', fn+' holds a '+name+' index, not an IVFPQ index'
+		ivf = cls(N=params['N'], D=params['D'], M=params['M'], Kt=params['Kt'], nlist=params['nlist'], dtype=np.dtype(str(params['dtype'])).type, verbose=verbose)
+		ivf.Cq, ivf.Lo, ivf.Li = arrays['Cq'], arrays['Lo'], arrays['Li']
+		ivf.pq = knnpq.PQ.fromarrays(params['pq'], dict((n[3:], a) for n, a in arrays.items() if n.startswith('pq.')), verbose=verbose)
+		return ivf
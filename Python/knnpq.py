@@ -5,11 +5,13 @@ import time
 import random
 import math
 import operator
-
-from mpl_toolkits.mplot3d import Axes3D
-import matplotlib
-matplotlib.use('Agg') # prevents interactive plots
-import matplotlib.pyplot as plt
+import mmap
+import threading
+import collections
+import knnstore
+import knnes
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 
 """
 N : Database size
@@ -24,17 +26,238 @@ C : codebook
 	Cn: number of point attched to the centroid
 	Cd: distances between centroid and a query
 Yt : encoded dataset Y; the set of vector indecies assigned to the sub-codeword in C
+Yp : 4-bit codes of Y (Kt <= 16), two subspaces per byte: a fast-scan copy of Yt, or with packed=True the only stored codes
+metric: distance ranked by every search, chosen when the index is built; smaller is nearer in all of them
+	l2 : squared euclidean distance ||q-y||^2
+	ip : negated inner product -q.y, for maximum inner product search
+	cos: cosine distance 1 - q.y/(||q|| ||y||); vectors and queries are normalized, then ranked by inner product
 """
 
+METRICS = ('l2', 'ip', 'cos')
+
+# rows of X scaled to unit length (zero rows are left as they are), as a new array
+def normalize(X):
+	X = np.array(X)
+	n = np.sqrt(np.einsum('...d,...d->...', X, X))[..., np.newaxis]
+	n[n == 0] = 1
+	X /= n
+	return X
+
+SCAN_BLOCK  = 2**14 # number of codes scanned per block; keeps a block's codes and partial sums in cache
+QUERY_BLOCK = 2**8  # number of queries sharing one pass over a block of codes in batched search
+
+# indices of the k smallest entries along the last axis of d, in no particular order
+def topk(d, k):
+	if k >= d.shape[-1]:
+		return np.broadcast_to(np.arange(d.shape[-1]), d.shape)
+	return np.argpartition(d, k-1, axis=-1)[..., :k]
+
+ASSIGN_BLOCK = 2**14 # number of vectors assigned to their nearest centroids per matrix product
+
+# nearest centroid in C (K,d) of every vector in X (n,d), in blocks of ASSIGN_BLOCK vectors
+# returns the centroid indices and the squared distances to them
+def assign(X, C):
+	C2 = np.einsum('kd,kd->k', C, C)
+	Cm2 = np.ascontiguousarray(-2 * C.T) # the -2 is folded into the centroids once instead of into every block product
+	labels = np.empty((len(X)), dtype=np.intp )
+	dists  = np.empty((len(X)), dtype=C.dtype)
+	for b in range(0, len(X), ASSIGN_BLOCK):
+		X_blk = np.asarray(X[b:b+ASSIGN_BLOCK], dtype=C.dtype)
+		# ||x-c||^2 = ||x||^2 - 2 x.c + ||c||^2; the ||x||^2 term does not change the nearest centroid
+		d = np.dot(X_blk, Cm2)
+		d += C2
+		labels[b:b+len(X_blk)] = d.argmin(axis=1)
+		dists[b:b+len(X_blk)]  = np.maximum(d[np.arange(len(X_blk)), labels[b:b+len(X_blk)]] + np.einsum('nd,nd->n', X_blk, X_blk), 0)
+	return labels, dists
+
+KMEANSPP_MAX = 2**10 # largest K seeded by k-means++; its seeding is K sequential passes over the seeding set
+SEED_RATIO   = 8     # the k-means++ seeding set holds at most this many candidates per centroid
+
+# k-means++ seeding: K initial centroids drawn from X with probability proportional to the squared
+# distance to the nearest centroid picked so far
+def kmeanspp(X, K, rs):
+	C = np.empty((K, X.shape[1]), dtype=X.dtype)
+	C[0] = X[rs.randint(len(X))]
+	d = np.einsum('nd,nd->n', X - C[0], X - C[0])
+	for k in range(1, K):
+		cdf = np.cumsum(d, dtype=np.float64)
+		i = np.searchsorted(cdf, rs.random_sample() * cdf[-1]) if cdf[-1] > 0 else rs.randint(len(X))
+		C[k] = X[min(i, len(X)-1)]
+		d = np.minimum(d, np.einsum('nd,nd->n', X - C[k], X - C[k]))
+	return C
+
+# K initial centroids for k-means of X: k-means++ over a random seeding set of at most SEED_RATIO*K vectors,
+# or for K > KMEANSPP_MAX (e.g. the upper HPQ levels, K = N/alpha) K distinct random vectors of X, so seeding
+# never costs more than O(KMEANSPP_MAX * SEED_RATIO * K * d)
+def kmeansinit(X, K, rs):
+	if K > KMEANSPP_MAX:
+		return np.array(X[np.sort(rs.choice(len(X), K, replace=False))])
+	n = SEED_RATIO * K
+	return kmeanspp(X[rs.choice(len(X), n, replace=False)] if n < len(X) else X, K, rs)
+
+# k-means of X (n,d) into K centroids, for training sets too large for a full kmeans2:
+# sample: fit on a random sample of this many vectors instead of all of X, raised to at least SEED_RATIO*K
+#         so the sample never falls below K (e.g. the upper HPQ levels, where K = N/alpha)
+# batch  : mini-batch updates with batches of this many vectors instead of full Lloyd iterations
+# centroids are seeded by kmeansinit() and iterations stop early once the mean squared centroid shift
+# falls below tol times the total variance of the training set. returns the (K,d) centroids
+def kmeans(X, K, iter=20, seed=7, sample=None, batch=None, tol=1e-4):
+	rs = np.random.RandomState(seed)
+	if sample is not None:
+		sample = max(sample, SEED_RATIO * K)
+	if sample is not None and sample < len(X):
+		# sorted indices keep the reads sequential when X is memory-mapped
+		X = X[np.sort(rs.choice(len(X), sample, replace=False))]
+	X = np.asarray(X)
+	assert K <= len(X), 'k-means needs at least K training vectors'
+	n = len(X)
+	if batch is None or batch >= n:
+		batch = None
+	C = kmeansinit(X, K, rs)
+	tol = tol * np.var(X, axis=0).sum()
+	v = np.zeros((K), dtype=np.float64) # number of vectors seen by each centroid, for mini-batch learning rates
+	for i in range(iter):
+		X_it = X if batch is None else X[rs.choice(n, batch, replace=False)]
+		labels,_ = assign(X_it, C)
+		cnt  = np.bincount(labels, minlength=K).astype(np.float64)
+		sums = np.empty((K, X.shape[1]), dtype=np.float64)
+		for j in range(X.shape[1]):
+			sums[:,j] = np.bincount(labels, weights=X_it[:,j], minlength=K)
+		C_ = C.astype(np.float64)
+		if batch is None:
+			# Lloyd step; empty clusters keep their previous centroid
+			nz = cnt > 0
+			C_[nz] = sums[nz] / cnt[nz, np.newaxis]
+		else:
+			# per-centroid learning rate 1/v: every centroid is the running mean of the vectors assigned to it
+			v += cnt
+			nz = cnt > 0
+			C_[nz] += (sums[nz] - cnt[nz, np.newaxis] * C_[nz]) / v[nz, np.newaxis]
+		shift = np.mean(np.sum((C_ - C)**2, axis=1))
+		C = C_.astype(X.dtype)
+		if shift <= tol:
+			break
+	return C
+
+ENCODE_BLOCK = 2**16 # number of vectors per chunk of the streaming encoder
+
+# PQ codes (n,M) of the vectors X (n,D) against the codebooks Cc (M,Kt,Dt)
+def encode(X, Cc, ctype=np.uint32):
+	M, Kt, Dt = Cc.shape
+	codes = np.empty((len(X), M), dtype=ctype)
+	for m in range(M):
+		codes[:,m],_ = assign(X[:, m*Dt : (m+1)*Dt], Cc[m])
+	return codes
+
+# codebooks of an encoding pool worker, set by the pool initializer so they are sent once per worker
+_encoder = None
+
+def _encode_init(Cc, ctype):
+	global _encoder
+	_encoder = (Cc, ctype)
+
+def _encode_chunk(X):
+	return encode(X, *_encoder)
+
+# append rows to the first n rows of the capacity buffer buf, growing it geometrically when full
+# returns the (possibly new) buffer and a view of its first n+len(rows) rows
+def append(buf, n, rows):
+	if n + len(rows) > len(buf):
+		new = np.zeros((max(2*len(buf), n+len(rows)),) + buf.shape[1:], dtype=buf.dtype)
+		new[:n] = buf[:n]
+		buf = new
+	buf[n:n+len(rows)] = rows
+	return buf, buf[:n+len(rows)]
+
+# 4-bit codes (n,M), Kt <= 16, packed two subspaces per byte, subspace 2j in the low and 2j+1 in the high nibble
+# of byte j; rows are padded to an even number of bytes so the fast scan reads them as 16-bit words. returns (n,(M+3)//4*2) uint8
+def packcodes(codes):
+	M = codes.shape[1]
+	Yp = np.zeros((len(codes), (M+3)//4*2), dtype=np.uint8)
+	Yp[:, :(M+1)//2] = codes[:, 0::2]
+	Yp[:, :M//2] |= (np.asarray(codes[:, 1::2], dtype=np.uint8) << 4)
+	return Yp
+
+# the (n,M) uint8 codes of the packed codes Yp (see packcodes)
+def unpackcodes(Yp, M):
+	codes = np.empty((len(Yp), M), dtype=np.uint8)
+	codes[:, 0::2] = Yp[:, :(M+1)//2] & 15
+	codes[:, 1::2] = Yp[:, :M//2] >> 4
+	return codes
+
+# training set of the build in progress: (Y, Yt, Dt, Kt, kmcIter, kmcSeed, kmcSample, kmcBatch, verbose), Yt None for codebooks only. set before
+# train_codebooks starts its pool so forked workers inherit the data instead of receiving a pickled copy
+_build = None
+
+# k-means for subspace m of the build in progress; writes the codes into the shared Yt (unless Yt is None,
+# when only the codebook is trained) and returns the codebook.
+# initial centroids are drawn from a per-subspace seed, so the result does not depend on which worker runs it
+def _kmeans_sub(m):
+	Y, Yt, Dt, Kt, kmcIter, kmcSeed, kmcSample, kmcBatch, verbose = _build
+	if verbose:
+		print 'k-means clustering for subspace:',m+1,'/',Y.shape[1]/Dt
+	# slice vector database into the m-th subspace
+	Y_sub = Y[:, m*Dt : (m+1)*Dt]
+	if kmcSample is None and kmcBatch is None:
+		init = Y_sub[np.random.RandomState(kmcSeed+m).choice(len(Y_sub), Kt, replace=False)]
+		Cc, labels = kmeans2(Y_sub, init, iter=kmcIter, minit='matrix')
+		if Yt is not None:
+			Yt[:,m] = labels
+	else:
+		# fit on a sample or mini-batches, then encode the whole subspace in a separate pass
+		Cc = kmeans(Y_sub, Kt, iter=kmcIter, seed=kmcSeed+m, sample=kmcSample, batch=kmcBatch)
+		if Yt is not None:
+			Yt[:,m],_ = assign(Y_sub, Cc)
+	return Cc
+
+# train the (M,Kt,Dt) codebooks of the M subspaces of the vectors Y (N,D), one k-means per subspace (see kmeans
+# for kmcSample / kmcBatch); workers > 1 trains the subspaces concurrently on a pool of 'process'es or 'thread's.
+# codes, an (N,M) array, receives the codes of Y as a by-product when given. returns the codebooks
+def train_codebooks(Y, M, Kt, kmcIter=20, kmcSeed=7, kmcSample=None, kmcBatch=None, workers=1, pool='process', codes=None, verbose=False):
+	global _build
+	assert pool in ('process', 'thread'), 'pool should be either process or thread'
+	Dt = Y.shape[1] / M
+	if codes is not None and workers > 1 and pool == 'process':
+		# codes are written by the workers into an anonymous shared mapping
+		buf = mmap.mmap(-1, codes.nbytes)
+		Yt = np.frombuffer(buf, dtype=codes.dtype).reshape(codes.shape)
+	else:
+		Yt = codes
+	_build = (Y, Yt, Dt, Kt, kmcIter, kmcSeed, kmcSample, kmcBatch, verbose)
+	try:
+		if workers > 1:
+			p = (ThreadPool, Pool)[pool == 'process'](min(workers, M))
+			try:
+				Cc = np.array(p.map(_kmeans_sub, range(M)))
+			finally:
+				p.close()
+				p.join()
+		else:
+			Cc = np.array([_kmeans_sub(m) for m in range(M)])
+	finally:
+		_build = None
+	if Yt is not codes:
+		codes[:] = Yt
+		del Yt
+		buf.close()
+	return Cc
+
 class PQ(object):
 
 	# initialize PQ class
-	def __init__(self, N, D, M, Kt, alpha=64, dtype=np.float32, readcsv=True, writecsv=True, verbose=False, plot=False, dump=False):
+	# rtype  : type of the kept copy X of the database vectors, None keeps no copy
+	# storage: index file to memory-map the index arrays from, None keeps them in memory
+	# metric : 'l2', 'ip' or 'cos' (see METRICS)
+	# packed : store the codes only as the 4-bit packed Yp (Kt <= 16), (M+3)//4*2 bytes per vector instead of Yt's M
+	#          (half of them for M a multiple of 4); Yt is then None and scans unpack the codes block by block
+	def __init__(self, N, D, M, Kt, alpha=64, dtype=np.float32, readcsv=True, writecsv=True, verbose=False, plot=False, dump=False, rtype=None, storage=None, metric='l2', packed=False):
 		# parameter checks
 		assert D % M == 0, 'equally divided sub-spaces are required; make sure M divides D'
 		assert Kt <= N, 'Kt, the number of sub-codewords in each subspace, should be smaller than the number of the database vectors'
 		assert 0 < Kt <= 2 ** 32, 'codebook should be smaller than 2**32'
 		assert 0 < alpha, 'tappering factor should be a positive number'
+		assert metric in METRICS, 'metric should be one of '+', '.join(METRICS)
+		assert not packed or Kt <= 16, 'packed 4-bit codes need Kt <= 16'
 		# assign parameters
 		self.N = N
 		self.D = D
@@ -42,6 +265,8 @@ class PQ(object):
 		self.Dt = D/M
 		self.Kt = Kt
 		self.H  = int(math.ceil(math.log(2048,2)/math.log(32,2)))
+		self.metric = metric
+		self.packed = packed
 
 		# code index type, based on the codebook length 'Kt'
 		self.ctype = ((np.uint32,np.uint16)[Kt<=2**16],np.uint8)[Kt<=2**8]
@@ -57,66 +282,109 @@ class PQ(object):
 		self.Cn = np.zeros((self.M, self.Kt         ), dtype=self.itype) # number of points attached to each centroid
 		self.Cd = np.zeros((self.M, self.Kt         ), dtype=self.dtype) # distances between sub-query vector and each centroid
 
-		# Yt: create 2d matrix of code index per sub-vector: [M subspaces][N vectors] encoded input vectors
-		self.Yt = np.zeros((self.N, self.M        ), dtype=self.ctype )
+		# Yt: create 2d matrix of code index per sub-vector: [M subspaces][N vectors] encoded input vectors; None when packed
+		self.Yt = None if packed else np.zeros((self.N, self.M), dtype=self.ctype)
+
+		# I: inverted lists in CSR layout, per subspace: ids of the vectors coded to the k-th codeword are
+		# Ii[m, Io[m,k] : Io[m,k+1]], sorted. rebuilt from Yt by ilists() whenever Istale is set
+		self.Io = np.zeros((self.M, self.Kt+1), dtype=np.int64 ) # list offsets
+		self.Ii = np.zeros((self.M, self.N   ), dtype=np.uint32) # list vector ids
+		self.Istale = True
+
+		# Yp: 4-bit codes packed two subspaces per byte (see packcodes). when packed, the stored codes themselves;
+		# otherwise an acceleration copy of Yt for search_fast, built by pack4() and None when stale, which adds half
+		# of Yt's bytes. save() stores it with the index, so loaded and memory-mapped indexes do not pack it again
+		self.Yp = np.zeros((self.N, (self.M+3)//4*2), dtype=np.uint8) if packed else None
 
-		# create 3d matrix of code indicators per sub-vector: [M subspaces][k codewords][N vector addresses]
-		self.I = np.zeros((self.M, self.Kt, self.N), dtype=np.uint8 )
+		# X: copy of the database vectors, for exact distances
+		self.rtype = rtype
+		self.X = None if rtype is None else np.zeros((self.N, self.D), dtype=rtype)
 
+		# dead: tombstones of removed vectors, skipped by searches until compact(); None when there are none
+		self.dead = None
+
+		# capacity buffers behind Yt (or Yp when packed), X and dead once vectors are appended by add()
+		self.buf = {}
+		# lock : held while the arrays are swapped or appended to; searches hold it only to take a snapshot
+		# wlock: serializes add, remove, update and compact
+		self.lock  = threading.RLock()
+		self.wlock = threading.RLock()
+
+		# out-of-core storage: move the (still untouched) arrays into a memory-mapped index file
+		self.storage = storage
+		if storage is not None:
+			specs = dict((name, (a.dtype, a.shape)) for name, a in self.arrays().items())
+			for name, a in knnstore.create(storage, 'PQ', self.params(), specs).items():
+				setattr(self, name, a)
 
 		self.readcsv = readcsv
 		self.writecsv = writecsv
 		self.verbose = verbose
 		self.plot = plot
 		if verbose:
-			print 'PQ class parameters: N:',N,', D:',D,', M:',M,', Dt:',self.Dt,', Kt: ',Kt,', ctype:',self.ctype
+			print 'PQ class parameters: N:',N,', D:',D,', M:',M,', Dt:',self.Dt,', Kt: ',Kt,', ctype:',self.ctype,', packed:',packed
 
 	##########################################
 
 	# construct the PQ databased
-	def construct(self, Y, kmcIter=20,kmcSeed=7):
+	# workers > 1 trains the M subspaces concurrently on a pool of 'process'es or 'thread's
+	# kmcSample / kmcBatch train the codebooks on a sample / with mini-batches of that many vectors (see kmeans)
+	def construct(self, Y, kmcIter=20,kmcSeed=7, workers=1, pool='process', kmcSample=None, kmcBatch=None):
 		# checks on vectors DB
 		assert Y.ndim     == 2         , 'Vectors database should be a two dimensional matrix'
 		assert Y.shape[0] == self.N    , 'Vectors database should have N vectors'
 		assert Y.shape[1] == self.D    , 'Vectors in database should be D-dimensional'
 		assert Y.dtype    == self.dtype, 'Vector type should be self.dtype'
+		assert pool in ('process', 'thread'), 'pool should be either process or thread'
+		# cos indexes the normalized vectors (a normalized copy of Y)
+		Y = self.prepare(Y)
 
 		if self.verbose:
 			print 'K-means clustering iterations#: '+repr(kmcIter)
 
+		# per-stage build timings in seconds
+		self.timings = {'csv': 0.0, 'kmeans': 0.0, 'group': 0.0, 'plot': 0.0}
+		t = time.time()
 		if self.writecsv:
 			np.savetxt(str(self.N)+'x'+str(self.D)+'-M'+str(self.M)+'-Kt'+str(self.Kt)+'-X'+'.csv', Y, delimiter=',')
-
-		# random seed for kmeams clustering 
-		np.random.seed(kmcSeed)
+		self.timings['csv'] += time.time() - t
 
 		# find k-means for each one of the M subspaces
-		for m in range(self.M):
+		t = time.time()
+		# packed codes are encoded once the codebooks are trained, chunk by chunk, without a full Yt
+		self.Cc[:] = train_codebooks(Y, self.M, self.Kt, kmcIter, kmcSeed, kmcSample, kmcBatch, workers, pool, None if self.packed else self.Yt, self.verbose)
+		if self.packed:
+			for b in range(0, self.N, ENCODE_BLOCK):
+				self.Yp[b:b+ENCODE_BLOCK] = packcodes(encode(Y[b:b+ENCODE_BLOCK], self.Cc, self.ctype))
+		self.timings['kmeans'] += time.time() - t
 
-			if self.verbose:
-				print 'k-means clustering for subspace:',m+1,'/',self.M
+		for m in range(self.M):
 
 			# slice vector database into the m-th subspace
 			Y_sub = Y[:, m*self.Dt : (m+1)*self.Dt]
 
-			# generate k-means for this subspace
-			self.Cc[m], self.Yt[:,m] = kmeans2(Y_sub, self.Kt, iter=kmcIter, minit='points')
+			t = time.time()
 			if self.writecsv:
 				np.savetxt(str(self.N)+'x'+str(self.D)+'-M'+str(self.M)+'-K'+str(self.Kt)+'-Z'+str(m)+'.csv', self.Cc[m], delimiter=',')
+			self.timings['csv'] += time.time() - t
 
-			# assign indicators matrix for each subspace
-			for ki in range(self.Kt):
-				for ni in range(self.N):
-					if self.Yt[ni,m]==ki:
-						self.I[m,ki,ni]=1
-						self.Cn[m,ki]+=1
+			# group the vectors by codeword: centroid counts and inverted lists
+			t = time.time()
+			self.group(m)
+			self.timings['group'] += time.time() - t
 
+			t = time.time()
 			if self.plot and (self.Dt==2 or self.Dt==3):
 				print 'plotting a figure for point and centroids of subspace '+repr(m)+' / '+repr(self.M)+' in figure '+'./kmeans'+repr(m)+' ...'
+				# imported only to plot, so indexes loaded by servers and readers do not pull in matplotlib
+				from mpl_toolkits.mplot3d import Axes3D
+				import matplotlib
+				matplotlib.use('Agg') # prevents interactive plots
+				import matplotlib.pyplot as plt
 				# colors for different centroids
 				colors  = ([('#e6194b', '#3cb44b', '#ffe119', '#4363d8', '#f58231', '#911eb4', '#46f0f0', \
                              '#f032e6', '#bcf60c', '#fabebe', '#008080', '#e6beff', '#9a6324', '#800000', \
-                             '#aaffc3', '#808000', '#ffd8b1', '#000075', '#808080', '#ffffff'               )[i] for i in self.Yt[:,m]])
+                             '#aaffc3', '#808000', '#ffd8b1', '#000075', '#808080', '#ffffff'               )[i] for i in self.column(m)])
 
 				fig = plt.figure()
 				if self.Dt==2:
@@ -136,42 +404,233 @@ class PQ(object):
 				# plot as png figure for each sub-space
 				fig.savefig('./kmeans'+repr(m)+'.png')
 				plt.close(fig)    # close the figure
+			self.timings['plot'] += time.time() - t
+		self.Istale = False
+		if self.X is not None:
+			for b in range(0, self.N, ASSIGN_BLOCK):
+				self.X[b:b+ASSIGN_BLOCK] = Y[b:b+ASSIGN_BLOCK]
+		self.flush()
+		t = time.time()
 		if self.writecsv:
-			np.savetxt(str(self.N)+'x'+str(self.D)+'-M'+str(self.M)+'-K'+str(self.Kt)+'-C'+'.csv', self.Yt, fmt='%4d', delimiter=',')
+			np.savetxt(str(self.N)+'x'+str(self.D)+'-M'+str(self.M)+'-K'+str(self.Kt)+'-C'+'.csv', self.codes(), fmt='%4d', delimiter=',')
+		self.timings['csv'] += time.time() - t
+		if self.verbose:
+			print 'PQ build timings (s):', self.timings
+			print 'PQ memory (bytes):', self.memory()
+		return self
+
+	# group the vectors of subspace m by codeword: centroid counts Cn[m] and the CSR inverted lists of m,
+	# written into Io[m] and Ii[m] (the index's own lists unless others are given)
+	# removed vectors stay in the lists (searches skip them) but are not counted in Cn
+	def group(self, m, Io=None, Ii=None):
+		Io = self.Io if Io is None else Io
+		Ii = self.Ii if Ii is None else Ii
+		codes = self.column(m)
+		counts = np.bincount(codes, minlength=self.Kt)
+		self.Cn[m] = counts if self.dead is None else np.bincount(codes[~self.dead], minlength=self.Kt)
+		# a stable sort keeps the ids of each list in ascending order
+		Ii[m] = np.argsort(codes, kind='mergesort')
+		Io[m,1:] = np.cumsum(counts)
+		return self
+
+	# codes (n,M) of the vectors rows (all of them by default), unpacked from Yp when the index is packed
+	def codes(self, rows=slice(None)):
+		if self.Yt is None:
+			return unpackcodes(self.Yp[rows], self.M)
+		return self.Yt[rows]
+
+	# codes of subspace m of the vectors rows (all of them by default), read from Yp when the index is packed
+	def column(self, m, rows=slice(None)):
+		if self.Yt is None:
+			return (self.Yp[rows, m//2] >> (4*(m%2))) & 15
+		return self.Yt[rows, m]
+
+	# the codes (n,M) of a block of rows of the code store Yc, Yt or the packed Yp
+	def block(self, Yc):
+		return unpackcodes(Yc, self.M) if self.packed else Yc
+
+	# build the CSR inverted lists (and centroid counts) from the codes Yt
+	# the lists are built aside and swapped in under the lock, so readers holding the old ones never see them
+	# half rebuilt; the mapped lists of an out-of-core index are copied into its file under the lock instead
+	def ilists(self):
+		with self.wlock:
+			Io = np.zeros((self.M, self.Kt+1), dtype=np.int64 )
+			Ii = np.zeros((self.M, self.N   ), dtype=np.uint32)
+			for m in range(self.M):
+				self.group(m, Io, Ii)
+			with self.lock:
+				if isinstance(self.Ii, np.memmap) and self.Ii.shape == Ii.shape:
+					self.Io[:], self.Ii[:] = Io, Ii
+				else:
+					self.Io, self.Ii = Io, Ii
+				self.Istale = False
+		return self
+
+	# a consistent snapshot (Io, Ii, dead, N) of the inverted lists and the tombstones, taken under the lock
+	# while add, remove and compact may run; stale lists are rebuilt first, by one concurrent reader while the others wait
+	def lists(self):
+		while True:
+			with self.lock:
+				if not self.Istale:
+					return self.Io, self.Ii, self.dead, self.N
+			with self.wlock:
+				if self.Istale:
+					self.ilists()
+
+	# ids of the vectors coded to codeword k of subspace m
+	def ilist(self, m, k):
+		Io, Ii, _, _ = self.lists()
+		return Ii[m, Io[m,k] : Io[m,k+1]]
+
+	# memory footprint of the index structures in bytes; 'I_dense' is what a one-byte-per-(m,k,n)
+	# indicator tensor would take, for comparison with the inverted lists 'I'; 'Yp' is the packed codes, the only
+	# codes of a packed index and otherwise the fast-scan copy next to 'Yt'
+	def memory(self):
+		mem = {'Cc': self.Cc.nbytes, 'Cn': self.Cn.nbytes,
+		       'I' : self.Io.nbytes + self.Ii.nbytes, 'I_dense': self.M * self.Kt * self.N}
+		if self.Yt is not None:
+			mem['Yt'] = self.Yt.nbytes
+		if self.Yp is not None:
+			mem['Yp'] = self.Yp.nbytes
+		return mem
+
+	# save the index to the binary index file fn (see knnstore)
+	def save(self, fn):
+		if self.Istale:
+			self.ilists()
+		knnstore.save(fn, 'PQ', self.params(), self.arrays())
+		return self
+
+	# write the memory-mapped arrays of an out-of-core index back to its file
+	def flush(self):
+		for a in self.arrays().values():
+			if isinstance(a, np.memmap):
+				a.flush()
 		return self
 
+	# load an index saved by save(); mmap='r' maps the arrays from the file instead of reading them
+	@classmethod
+	def load(cls, fn, mmap=None, verbose=False):
+		name, params, arrays = knnstore.load(fn, mmap)
+		assert name == 'PQ', fn+' holds a '+name+' index, not a PQ index'
+		return cls.fromarrays(params, arrays, verbose=verbose)
+
+	# parameters and arrays that make up the index, as stored by save()
+	def params(self):
+		return {'N': self.N, 'D': self.D, 'M': self.M, 'Kt': self.Kt, 'dtype': np.dtype(self.dtype).name,
+		        'rtype': None if self.rtype is None else np.dtype(self.rtype).name, 'metric': self.metric, 'packed': self.packed}
+
+	def arrays(self):
+		arrays = {'Cc': self.Cc, 'Cn': self.Cn, 'Io': self.Io, 'Ii': self.Ii}
+		if self.Yt is not None:
+			arrays['Yt'] = self.Yt
+		if self.X is not None:
+			arrays['X'] = self.X
+		if self.dead is not None:
+			arrays['dead'] = self.dead
+		if self.Yp is not None:
+			arrays['Yp'] = self.Yp
+		return arrays
+
+	# instantiate a constructed index from params() and arrays()
+	@classmethod
+	def fromarrays(cls, params, arrays, verbose=False):
+		rtype = params.get('rtype')
+		pq = cls(N=params['N'], D=params['D'], M=params['M'], Kt=params['Kt'], dtype=np.dtype(str(params['dtype'])).type, readcsv=False, writecsv=False, verbose=verbose,
+		         rtype=None if rtype is None else np.dtype(str(rtype)).type, metric=str(params.get('metric', 'l2')), packed=params.get('packed', False))
+		for name, a in arrays.items():
+			if name == 'dead':
+				assert a.shape == (pq.N,) and a.dtype == np.bool_, 'array dead does not match the index parameters'
+			elif name == 'Yp':
+				assert a.shape == (pq.N, (pq.M+3)//4*2) and a.dtype == np.uint8, 'array Yp does not match the index parameters'
+			else:
+				assert a.shape == getattr(pq, name).shape and a.dtype == getattr(pq, name).dtype, 'array '+name+' does not match the index parameters'
+			setattr(pq, name, a)
+		pq.Istale = False
+		return pq
+
 	# vectors batch quantization
-	def qvec_(self, vecs):
-		# checks on vectors DB
-		assert vecs.ndim     == 2         , 'Vectors database should be a two dimensional matrix'
-		assert vecs.shape[1] == self.D    , 'Vectors in database should be D-dimensional'
-		assert vecs.dtype    == self.dtype, 'Vector type should be self.dtype'
-		Nq = vecs.shape[0] # number of query vectors
+	# streams vecs, an (n,D) array or memory-mapped array or an iterator of (n_i,D) arrays, through the encoder
+	# in chunks of at most chunk vectors; workers > 1 encodes chunks on a process pool with a bounded number in flight.
+	# codes are written into out (e.g. the Yt of an out-of-core index) when given; returns the (n,M) codes
+	def qvec_(self, vecs, chunk=ENCODE_BLOCK, workers=1, out=None):
+		if isinstance(vecs, np.ndarray):
+			# checks on vectors DB
+			assert vecs.ndim     == 2         , 'Vectors database should be a two dimensional matrix'
+			assert vecs.shape[1] == self.D    , 'Vectors in database should be D-dimensional'
+			if out is None:
+				out = np.empty((len(vecs), self.M), dtype=self.ctype)
+			Y = vecs
+			vecs = (Y[b:b+chunk] for b in range(0, len(Y), chunk))
 		# qcodes[n][m] : code of n-th vec, m-th subspace
-		qcodes = np.empty((Nq, self.M), dtype=self.ctype)
-		for m in range(self.M):
+		qcodes = []
+		n = 0
+		for codes in self.encode_stream(vecs, workers):
+			if out is None:
+				qcodes.append(codes)
+			else:
+				out[n:n+len(codes)] = codes
+			n += len(codes)
 			if self.verbose:
-				print("Encoding the subspace: {} / {}".format(m, self.M))
-			vecs_sub = vecs[:, m * self.Dt : (m+1) * self.Dt]
-			qcodes[:, m], _ = vq(vecs_sub, self.codewords[m])
-		return qcodes
+				print 'Encoded vectors:',n
+		if out is None:
+			return np.concatenate(qcodes) if qcodes else np.empty((0, self.M), dtype=self.ctype)
+		return out[:n]
+
+	# codes of every chunk of the iterator chunks, in order
+	def encode_stream(self, chunks, workers=1):
+		if workers <= 1:
+			for X in chunks:
+				yield encode(self.prepare(X), self.Cc, self.ctype)
+			return
+		p = Pool(workers, _encode_init, (self.Cc, self.ctype))
+		try:
+			pending = collections.deque()
+			for X in chunks:
+				pending.append(p.apply_async(_encode_chunk, (np.ascontiguousarray(self.prepare(X)),)))
+				# bound the chunks in flight so memory does not grow with the input
+				if len(pending) >= 2*workers:
+					yield pending.popleft().get()
+			while pending:
+				yield pending.popleft().get()
+		finally:
+			p.terminate()
+			p.join()
+
+	# vectors as the index holds them: normalized for cos, as they are otherwise
+	def prepare(self, vecs):
+		vecs = np.asarray(vecs, dtype=self.dtype)
+		return normalize(vecs) if self.metric == 'cos' else vecs
+
+	# distance lookup table of a query vector: Cd[m,k] is the part of the metric's distance contributed by
+	# codeword k of subspace m, ||qvec_m - Cc[m,k]||^2 for l2, -qvec_m.Cc[m,k] for ip, 1/M - qvec_m.Cc[m,k] for cos
+	# (so the M parts add up to the distance). computed for all subspaces and codewords at once; returns a fresh (M,Kt) table
+	def lut(self, qvec):
+		qvec = self.prepare(qvec)
+		if self.metric == 'l2':
+			diff = self.Cc - qvec.reshape(self.M, 1, self.Dt)
+			return np.einsum('mkd,mkd->mk', diff, diff)
+		Cd = np.einsum('mkd,md->mk', self.Cc, qvec.reshape(self.M, self.Dt))
+		np.negative(Cd, out=Cd)
+		if self.metric == 'cos':
+			Cd += self.dtype(1.0 / self.M)
+		return Cd
 
 	# update distances based on query vector
+	# writes the shared self.Cd, so concurrent queries must use lut() instead
 	def udist(self, qvec):
-		for m in range(self.M):
-			for k in range(self.Kt):
-				qvec_sub = qvec[m*self.Dt : (m+1)*self.Dt]
-				self.Cd[m,k]= self.euclideanDistSqr(self.Cc[m,k],qvec_sub)
+		self.Cd[:] = self.lut(qvec)
 		return self
 
 	def prune(self, qvec):
-		self.udist(qvec)
+		Cd = self.lut(qvec)
+		Yt = self.codes()
 		mini = 0
-		mina = [self.Cd[m,self.Yt[mini,m]] for m in range(self.M)]
+		mina = [Cd[m,Yt[mini,m]] for m in range(self.M)]
 		mind = sum(mina)
 		pruned=0
 		for n in range(1,self.N):
-			cura = [self.Cd[m,self.Yt[n,m]] for m in range(self.M)]
+			cura = [Cd[m,Yt[n,m]] for m in range(self.M)]
 			curd = sum(cura)
 			if np.all(np.greater_equal(cura,mina)):
 				pruned+=1
@@ -182,17 +641,18 @@ class PQ(object):
 		return pruned
 				
 	def pruneMulti(self, qvec, k):
-		self.udist(qvec)
+		Cd = self.lut(qvec)
+		Yt = self.codes()
 		mini = np.zeros((k       ), dtype=self.itype)
 		mina = np.zeros((k,self.M), dtype=self.dtype)
 		mind = np.zeros((k       ), dtype=self.dtype)
 		for ki in range(k):
 			mini[ki] = ki
-			mina[ki] = [self.Cd[m,self.Yt[mini[ki],m]] for m in range(self.M)]
+			mina[ki] = [Cd[m,Yt[mini[ki],m]] for m in range(self.M)]
 			mind[ki] = sum(mina[ki])
 		pruned=0
 		for n in range(k,self.N):
-			cura = [self.Cd[m,self.Yt[n,m]] for m in range(self.M)]
+			cura = [Cd[m,Yt[n,m]] for m in range(self.M)]
 			curd = sum(cura)
 			if np.any([np.all(np.greater_equal(cura,mina[ki])) for ki in range(k)]):
 				pruned+=1
@@ -203,66 +663,414 @@ class PQ(object):
 				mind[maxi]=curd
 		return pruned
 
+	# distance lookup tables of a batch of query vectors Q (nq,D) (see lut), returned as (nq,M,Kt)
+	# expands ||q_m - c||^2 = ||q_m||^2 - 2 q_m.c + ||c||^2 so the cross terms are one matrix product per subspace
+	def luts(self, Q):
+		Q_sub = self.prepare(Q).reshape(-1, self.M, self.Dt).transpose(1, 0, 2)
+		L = np.matmul(Q_sub, self.Cc.transpose(0, 2, 1)) # (M,nq,Kt) cross terms
+		if self.metric != 'l2':
+			np.negative(L, out=L)
+			if self.metric == 'cos':
+				L += self.dtype(1.0 / self.M)
+			return L.transpose(1, 0, 2)
+		L *= -2
+		L += np.einsum('mqd,mqd->mq', Q_sub, Q_sub)[:, :, np.newaxis]
+		L += np.einsum('mkd,mkd->mk', self.Cc, self.Cc)[:, np.newaxis, :]
+		np.maximum(L, 0, out=L) # clip the rounding error of the expansion
+		return L.transpose(1, 0, 2)
+
+	# scan engine: sum Cd[m,Yt[n,m]] over the codes (or only the rows in sidx) block by block, unpacking the blocks of a packed index
+	# returns the ids of the k nearest codes and their approximate distances, nearest first
+	def scan(self, Cd, k, sidx=None):
+		ids, dists = self.scan_batch(Cd[np.newaxis], k, sidx)
+		live = ids[0] >= 0
+		return ids[0][live], dists[0][live]
+
+	# batched scan engine over lookup tables L (nq,M,Kt); every block of codes is gathered once
+	# for up to QUERY_BLOCK queries. returns (nq,k) ids and approximate distances, nearest first
+	def scan_batch(self, L, k, sidx=None):
+		# a consistent view of the codes and tombstones, even while compact() swaps them
+		with self.lock:
+			Yt, dead = (self.Yt, self.Yp)[self.packed], self.dead
+		if sidx is not None:
+			sidx = np.asarray(sidx, dtype=np.intp)
+		n  = len(Yt) if sidx is None else len(sidx)
+		nq = L.shape[0]
+		k  = min(k, n)
+		Lm = np.ascontiguousarray(np.asarray(L, dtype=self.dtype).transpose(1, 0, 2)) # (M,nq,Kt)
+		bid   = np.zeros((nq, 0), dtype=np.intp     )
+		bdist = np.zeros((nq, 0), dtype=self.dtype)
+		dist  = np.empty((min(nq, QUERY_BLOCK), min(n, SCAN_BLOCK)), dtype=self.dtype)
+		tmp   = np.empty((min(nq, QUERY_BLOCK), min(n, SCAN_BLOCK)), dtype=self.dtype)
+		for b in range(0, n, SCAN_BLOCK):
+			if sidx is None:
+				# out-of-core codes: ask for the next block to be read in while this one is scanned
+				knnstore.advise(Yt, b+SCAN_BLOCK, b+2*SCAN_BLOCK)
+				ids = np.arange(b, min(b+SCAN_BLOCK, n))
+				codes = self.block(Yt[b:b+SCAN_BLOCK])
+			else:
+				ids = sidx[b:b+SCAN_BLOCK]
+				codes = self.block(Yt[ids])
+			cid   = []
+			cdist = []
+			for q in range(0, nq, QUERY_BLOCK):
+				qs = slice(q, q+QUERY_BLOCK)
+				nb = len(Lm[0, qs])
+				d, t = dist[:nb, :len(ids)], tmp[:nb, :len(ids)]
+				np.take(Lm[0, qs], codes[:,0], axis=1, out=d)
+				for m in range(1, self.M):
+					np.take(Lm[m, qs], codes[:,m], axis=1, out=t)
+					d += t
+				if dead is not None:
+					d[:, dead[ids]] = np.inf
+				sel = topk(d, k)
+				cid.append(ids[sel])
+				cdist.append(np.take_along_axis(d, sel, axis=1))
+			# merge the block into the running top-k
+			bid   = np.concatenate((bid  , np.concatenate(cid  )), axis=1)
+			bdist = np.concatenate((bdist, np.concatenate(cdist)), axis=1)
+			sel = topk(bdist, k)
+			bid   = np.take_along_axis(bid  , sel, axis=1)
+			bdist = np.take_along_axis(bdist, sel, axis=1)
+		order = bdist.argsort(axis=1)
+		bid, bdist = np.take_along_axis(bid, order, axis=1), np.take_along_axis(bdist, order, axis=1)
+		if dead is not None:
+			# fewer than k live vectors
+			bid[np.isinf(bdist)] = -1
+		return bid, bdist
+
+	# exact re-ranking: squared distances of the query vectors Q (nq,D) to the kept database vectors of the
+	# candidates ids (nq,R), padded with -1, in one pass. returns the (nq,k) nearest candidates and their exact distances
+	def rerank_batch(self, Q, ids, k):
+		assert self.X is not None, 'exact re-ranking needs the database vectors; construct the index with an rtype'
+		Q = self.prepare(Q)
+		ids = np.asarray(ids)
+		valid = ids >= 0
+		# one gather of the candidate vectors, in ascending id order for memory-mapped stores
+		uids, inv = np.unique(ids[valid], return_inverse=True)
+		V = np.zeros(ids.shape + (self.D,), dtype=self.dtype)
+		V[valid] = np.asarray(self.X[uids], dtype=self.dtype)[inv]
+		if self.metric == 'l2':
+			V -= Q[:, np.newaxis, :]
+			dist = np.einsum('qrd,qrd->qr', V, V)
+		else:
+			dist = -np.einsum('qrd,qd->qr', V, Q)
+			if self.metric == 'cos':
+				dist += 1
+		dist[~valid] = np.inf
+		k = min(k, ids.shape[1])
+		sel = topk(dist, k)
+		order = np.take_along_axis(dist, sel, axis=1).argsort(axis=1)
+		sel = np.take_along_axis(sel, order, axis=1)
+		ids, dist = np.take_along_axis(ids, sel, axis=1), np.take_along_axis(dist, sel, axis=1)
+		ids[np.isinf(dist)] = -1
+		return ids, dist
+
+	def rerank(self, qvec, ids, k):
+		ids, dist = self.rerank_batch(np.asarray(qvec)[np.newaxis], np.asarray(ids)[np.newaxis], k)
+		live = ids[0] >= 0
+		return ids[0][live], dist[0][live]
+
+	# batched KNN-PQ-ES search of the query vectors Q (nq,D); returns (nq,k) ids and approximate distances
+	# rerank > 0 re-ranks the best max(rerank,k) PQ candidates by their exact distances, which are returned instead
+	def search_batch(self, Q, k, sidx=None, rerank=0):
+		if rerank > 0:
+			ids,_ = self.scan_batch(self.luts(Q), max(rerank, k), sidx)
+			return self.rerank_batch(Q, ids, k)
+		return self.scan_batch(self.luts(Q), k, sidx)
+
+	# KNN-PQ-ES search; returns ids and approximate distances (exact ones after rerank, see search_batch)
+	def search(self, qvec, k, sidx=None, rerank=0):
+		if rerank > 0:
+			ids,_ = self.search(qvec, max(rerank, k), sidx)
+			return self.rerank(qvec, ids, k)
+		return self.scan(self.lut(qvec), k, sidx)
+
+	# KNN-PQ-ES search with dominance pruning (the blockwise form of prune/pruneMulti): a vector whose partial
+	# distance is, in every subspace, at least the largest partial distance among the current top-k members
+	# cannot enter the top-k, so it is dropped before its partial distances are summed and ranked.
+	# returns ids, approximate distances and the fraction of the scanned vectors that was pruned
+	def search_prune(self, qvec, k, sidx=None):
+		Cd = self.lut(qvec)
+		with self.lock:
+			Yt, dead = (self.Yt, self.Yp)[self.packed], self.dead
+		if sidx is not None:
+			sidx = np.asarray(sidx, dtype=np.intp)
+		n = len(Yt) if sidx is None else len(sidx)
+		k = min(k, n)
+		bid   = np.zeros((0        ), dtype=np.intp     )
+		bdist = np.zeros((0        ), dtype=self.dtype)
+		bpart = np.zeros((self.M, 0), dtype=self.dtype) # partial distances of the top-k members
+		part  = np.empty((self.M, min(n, SCAN_BLOCK)), dtype=self.dtype)
+		pruned = 0
+		for b in range(0, n, SCAN_BLOCK):
+			if sidx is None:
+				knnstore.advise(Yt, b+SCAN_BLOCK, b+2*SCAN_BLOCK)
+				ids = np.arange(b, min(b+SCAN_BLOCK, n))
+				codes = self.block(Yt[b:b+SCAN_BLOCK])
+			else:
+				ids = sidx[b:b+SCAN_BLOCK]
+				codes = self.block(Yt[ids])
+			P = part[:, :len(ids)]
+			for m in range(self.M):
+				np.take(Cd[m], codes[:,m], out=P[m])
+			alive = np.ones((len(ids)), dtype=np.bool_) if dead is None else ~dead[ids]
+			if bid.shape[0] == k:
+				# dominance test against the component-wise maximum of the top-k partial distances
+				Pmax = bpart.max(axis=1)
+				keep = P[0] < Pmax[0]
+				for m in range(1, self.M):
+					keep |= P[m] < Pmax[m]
+				pruned += np.count_nonzero(alive & ~keep)
+				alive &= keep
+			sel = np.flatnonzero(alive)
+			if not len(sel):
+				continue
+			d = P[:, sel].sum(axis=0)
+			# merge the surviving vectors into the running top-k
+			bid   = np.concatenate((bid  , ids[sel]    ))
+			bdist = np.concatenate((bdist, d           ))
+			bpart = np.concatenate((bpart, P[:, sel]), axis=1)
+			top = topk(bdist, k)
+			bid, bdist, bpart = bid[top], bdist[top], bpart[:, top]
+		order = bdist.argsort()
+		return bid[order], bdist[order], pruned / float(max(n, 1))
+
+	# pack the codes into the fast-scan copy Yp (see packcodes; Yt is kept), a no-op for a packed index
+	# for an out-of-core index Yp is held in memory until the index is saved
+	def pack4(self):
+		assert self.Kt <= 16, 'packed 4-bit codes need Kt <= 16'
+		if self.packed:
+			return self
+		with self.lock:
+			Yt = self.Yt
+		Yp = np.zeros((len(Yt), (self.M+3)//4*2), dtype=np.uint8)
+		for b in range(0, len(Yt), ENCODE_BLOCK):
+			Yp[b:b+ENCODE_BLOCK] = packcodes(Yt[b:b+ENCODE_BLOCK])
+		self.Yp = Yp
+		return self
+
+	# lookup table of qvec quantized to uint8: per-subspace offsets and one scale, so that the quantized
+	# distances of all M subspaces add up in uint16 without overflow. returns (M,Kt) uint8 table
+	def lut8(self, Cd):
+		Cd = Cd - Cd.min(axis=1)[:, np.newaxis]
+		top = Cd.max()
+		scale = 255 / top if top > 0 else 0
+		return np.minimum(np.floor(Cd * scale), 255).astype(np.uint8)
+
+	# fast-scan KNN-PQ-ES search for Kt <= 16: scans the packed 4-bit codes with a uint8 lookup table, reading
+	# them as 16-bit words (four subspaces each) through one 65536-entry table per word column, summed into
+	# uint16 accumulators. once the shortlist of the best candidates is full, a block only contributes the codes
+	# below its worst entry; the shortlist is then re-scored exactly with the float lookup table.
+	# returns ids and approximate distances
+	def search_fast(self, qvec, k, shortlist=None):
+		with self.lock:
+			Yp, dead = self.Yp, self.dead
+		if Yp is None:
+			with self.wlock:
+				if self.Yp is None:
+					self.pack4()
+				Yp, dead = self.Yp, self.dead
+		Cd = self.lut(qvec)
+		Cd8 = np.zeros((2*Yp.shape[1], 16), dtype=np.uint16)
+		Cd8[:self.M, :self.Kt] = self.lut8(Cd)
+		# T[j][b]: quantized distance of the code byte b in byte column j
+		T = Cd8[0::2][:, np.newaxis, :] + Cd8[1::2][:, :, np.newaxis]
+		T = T.reshape(len(T), 256)
+		# W[j][w]: quantized distance of the little-endian code word w in word column j (byte columns 2j and 2j+1)
+		W = T[0::2][:, np.newaxis, :] + T[1::2][:, :, np.newaxis]
+		W = W.reshape(len(W), 65536)
+		n = len(Yp)
+		R = min(n, shortlist if shortlist is not None else max(4*k, 64))
+		bid  = np.zeros((0), dtype=np.intp  )
+		bacc = np.zeros((0), dtype=np.uint16)
+		acc  = np.empty((min(n, SCAN_BLOCK)), dtype=np.uint16)
+		tmp  = np.empty((min(n, SCAN_BLOCK)), dtype=np.uint16)
+		for b in range(0, n, SCAN_BLOCK):
+			codes = np.ascontiguousarray(Yp[b:b+SCAN_BLOCK]).view('<u2')
+			a, t = acc[:len(codes)], tmp[:len(codes)]
+			np.take(W[0], codes[:,0], out=a)
+			for j in range(1, len(W)):
+				np.take(W[j], codes[:,j], out=t)
+				a += t
+			if dead is not None:
+				a[dead[b:b+SCAN_BLOCK]] = np.iinfo(np.uint16).max
+			sel = topk(a, R) if len(bid) < R else np.flatnonzero(a < bacc.max())
+			if not len(sel):
+				continue
+			bid  = np.concatenate((bid , b + sel))
+			bacc = np.concatenate((bacc, a[sel] ))
+			if len(bid) > R:
+				sel = topk(bacc, R)
+				bid, bacc = bid[sel], bacc[sel]
+		if dead is not None:
+			bid = bid[~dead[bid]]
+		# exact re-scoring of the shortlist
+		codes = Yp[bid]
+		dist = np.zeros((len(bid)), dtype=self.dtype)
+		for m in range(self.M):
+			dist += Cd[m][(codes[:, m//2] >> (4*(m%2))) & 15]
+		sel = topk(dist, k)
+		sel = sel[dist[sel].argsort()]
+		return bid[sel], dist[sel]
+
 	# KNN-PQ-ES query
-	def knnpqes(self, qvec, k):
-		dist = np.zeros((self.N), dtype=self.dtype)
-		#dSum = np.zeros((self.N), dtype=self.dtype)
-		self.udist(qvec)
-		for n in range(self.N):
-		#	for m in range(self.M):
-		#		dist[n] += self.Cd[m,self.Yt[n,m]]
-			dist[n] = sum([self.Cd[m,self.Yt[n,m]] for m in range(self.M)])
-		kmax = dist.argsort()[:k]
+	def knnpqes(self, qvec, k, rerank=0):
+		kmax,_ = self.search(qvec, k, rerank=rerank)
 		return kmax
 
 	# KNN-PQ-ES query / selective search indices
-	def knnpqes_sel(self, qvec, k, sidx):
-		dist = np.full((self.N), np.finfo(self.dtype).max, self.dtype)
-		#dSum = np.zeros((self.N), dtype=self.dtype)
-		self.udist(qvec)
-		for n in sidx:
-		#	for m in range(self.M):
-		#		dist[n] += self.Cd[m,self.Yt[n,m]]
-			dist[n] = sum([self.Cd[m,self.Yt[n,m]] for m in range(self.M)])
-		kmax = dist.argsort()[:k]
+	def knnpqes_sel(self, qvec, k, sidx, rerank=0):
+		kmax,_ = self.search(qvec, k, sidx, rerank=rerank)
 		return kmax
 
 	#def knnhpq(self, qvec, k):
 
 
 	def update(self, uvec, uidx):
-		for m in range(self.M):
-			uvec_sub = uvec[m*self.Dt : (m+1)*self.Dt]
-			cid,_,_ = self.knnes(self.Cc[m],uvec_sub,1,self.euclideanDistSqr)
-			self.I[m,self.Yt[uidx,m],uidx]=0
-			self.Yt[uidx,m]=cid
-			self.I[m,cid,uidx]=1
+		return self.update_batch(np.asarray(uvec)[np.newaxis], [uidx])
+
+	# re-encode the vectors vecs (n,D) in place of the database vectors idxs (n); when an index
+	# repeats, its last vector wins. codes and centroid counts are rewritten with one nearest-centroid
+	# pass per subspace; the inverted lists are rebuilt once, on the next lookup
+	def update_batch(self, vecs, idxs):
+		vecs = self.prepare(vecs)
+		idxs = np.asarray(idxs, dtype=np.intp)
+		assert vecs.shape == (len(idxs), self.D), 'update vectors should be D-dimensional, one per index'
+		_, last = np.unique(idxs[::-1], return_index=True)
+		keep = len(idxs) - 1 - last
+		vecs, idxs = vecs[keep], idxs[keep]
+		with self.wlock:
+			live = idxs if self.dead is None else idxs[~self.dead[idxs]]
+			codes = encode(vecs, self.Cc, self.ctype)
+			old = self.codes(live)
+			if self.packed:
+				self.Yp[idxs] = packcodes(codes)
+			else:
+				self.Yt[idxs] = codes
+			for m in range(self.M):
+				self.Cn[m] = self.Cn[m].astype(np.int64) + np.bincount(self.column(m, live), minlength=self.Kt) - np.bincount(old[:,m], minlength=self.Kt)
+			if self.X is not None:
+				self.X[idxs] = vecs
+			# inverted lists are rebuilt lazily on the next lookup
+			self.Istale = True
+			if not self.packed:
+				self.Yp = None
 		return self
 
-	def query(self, qvec, k, kc):
-		indcs = np.zeros((self.M, kc, self.N), dtype=np.uint8  )
-		indcs_ = np.zeros((self.M, kc, self.N), dtype=self.dtype)
+	# encode the vectors vecs (n,D) against the existing codebooks and append them to the index
+	# vecs may also be an iterator of (n_i,D) arrays, streamed in chunk by chunk; returns the ids given to the new vectors
+	def add(self, vecs):
+		assert self.storage is None, 'vectors cannot be added to an out-of-core index'
+		if not isinstance(vecs, np.ndarray):
+			ids = [self.add(X) for X in vecs]
+			return np.concatenate(ids) if ids else np.zeros((0), dtype=np.intp)
+		vecs = self.prepare(vecs)
+		assert vecs.ndim == 2 and vecs.shape[1] == self.D, 'Vectors to add should be D-dimensional'
+		codes = encode(vecs, self.Cc, self.ctype)
+		with self.wlock:
+			n = self.N
+			with self.lock:
+				if self.packed:
+					self.buf['Yp'], self.Yp = append(self.buf.get('Yp', self.Yp), n, packcodes(codes))
+				else:
+					self.buf['Yt'], self.Yt = append(self.buf.get('Yt', self.Yt), n, codes)
+				if self.X is not None:
+					self.buf['X'], self.X = append(self.buf.get('X', self.X), n, vecs)
+				if self.dead is not None:
+					self.buf['dead'], self.dead = append(self.buf.get('dead', self.dead), n, np.zeros((len(vecs)), dtype=np.bool_))
+				self.N = n + len(vecs)
+				# promote the data index type once N outgrows it
+				itype = ((np.uint32,np.uint16)[self.N<=2**16],np.uint8)[self.N<=2**8]
+				if np.dtype(itype).itemsize > np.dtype(self.itype).itemsize:
+					self.itype = itype
+					self.Cn = self.Cn.astype(itype)
+				for m in range(self.M):
+					self.Cn[m] += np.bincount(codes[:,m], minlength=self.Kt).astype(self.itype)
+				self.Istale = True
+				if not self.packed:
+					self.Yp = None
+		return np.arange(n, n + len(vecs))
+
+	# mark the vectors ids as removed; searches skip them and compact() reclaims their space
+	def remove(self, ids):
+		ids = np.unique(np.asarray(ids, dtype=np.intp))
+		with self.wlock:
+			with self.lock:
+				if self.dead is None:
+					self.dead = np.zeros((self.N), dtype=np.bool_)
+				ids = ids[~self.dead[ids]]
+				for m in range(self.M):
+					self.Cn[m] -= np.bincount(self.column(m, ids), minlength=self.Kt).astype(self.itype)
+				self.dead[ids] = True
+		return self
+
+	# drop the removed vectors from the index; the remaining vectors are renumbered in order.
+	# returns the map of old ids to new ones (-1 for removed vectors). with background=True the
+	# compaction runs on its own thread while searches go on against the old arrays, and an AsyncResult
+	# is returned instead, whose get() waits for the compaction and returns the map
+	def compact(self, background=False):
+		if background:
+			p = ThreadPool(1)
+			res = p.apply_async(self.compact)
+			# the pool thread exits once the compaction is done
+			p.close()
+			return res
+		with self.wlock:
+			remap = np.arange(self.N)
+			if self.dead is None:
+				return remap
+			keep = ~self.dead
+			remap[self.dead] = -1
+			remap[keep] = np.arange(np.count_nonzero(keep))
+			Yt = None if self.Yt is None else self.Yt[keep]
+			Yp = None if self.Yp is None or not self.packed else self.Yp[keep]
+			X  = None if self.X is None else self.X[keep]
+			with self.lock:
+				self.Yt, self.Yp, self.X, self.dead, self.N = Yt, Yp, X, None, int(np.count_nonzero(keep))
+				self.buf = {}
+				self.Istale = True
+			self.ilists()
+		return remap
+
+	def query(self, qvec, k, kc, rerank=0):
 		cid   = np.zeros((self.M, kc        ), dtype=self.ctype)
 		dists = np.zeros((self.M, kc        ), dtype=self.dtype)
-		inf = 2
+		Cd = self.lut(qvec)
+		inf = 2 if self.metric == 'l2' else Cd.max()
+		# one snapshot of the lists, tombstones and size, so add, remove and compact may run meanwhile
+		Io, Ii, dead, N = self.lists()
+		# iOR[m,n]: distance of the n-th vector's code in subspace m if it is one of the kc nearest codewords, inf otherwise
+		iOR = np.full((self.M, N), inf, dtype=self.dtype)
 		for m in range(self.M):
-			qvec_sub = qvec[m*self.Dt : (m+1)*self.Dt]
-			cid[m],_,dists[m] = self.knnes(self.Cc[m],qvec_sub,kc,self.euclideanDistSqr)
-			indcs[m][:] = self.I[m][cid[m][:]]
+			# the kc nearest codewords of subspace m under the index metric
+			cid[m] = np.argsort(Cd[m], kind='mergesort')[:kc]
+			dists[m] = Cd[m][cid[m]]
 			for kci in range(kc):
-				indcs_[m][kci] = self.I[m][cid[m][kci]]*dists[m][kci]
-		indcs_[indcs_==0] = inf
-		iOR = np.zeros((self.M,self.N), dtype=np.uint8)
-		iOR = np.min(indcs_,axis=1)
-		iSum = np.zeros((self.N), dtype=np.uint8)
+				iOR[m][Ii[m, Io[m,cid[m][kci]] : Io[m,cid[m][kci]+1]]] = dists[m][kci]
 		iSum = np.sum(iOR,axis=0)
+		if dead is not None:
+			iSum[dead] = np.inf
 		#kmax = iSum.argsort()[-k:][::-1]
-		kmax = iSum.argsort()[:k]
-		return indcs, indcs_, dists, iOR, iSum, kmax
+		if rerank > 0:
+			kmax,_ = self.rerank(qvec, iSum.argsort()[:max(rerank, k)], k)
+		else:
+			kmax = iSum.argsort()[:k]
+		return dists, iOR, iSum, kmax
 
 	# KNN-ES
 	# find k-nearest neighbours of qVec in the database Y using simFunc for compares
+	# euclidean distances and cosine similarities are computed by the blocked exact search knnes.knn, other simFuncs
+	# one vector at a time. cosineSim is a similarity: its neighbours are the most similar vectors, in decreasing similarity
 	def knnes(self, Y, qVec, k, simFunc):
+		if simFunc in (self.euclideanDistSqr, self.euclideanDist, self.cosineSim):
+			ids, dists = knnes.knn(Y, qVec, k, ('l2', 'cos')[simFunc == self.cosineSim])
+			ids, dists = ids[0].astype(np.uint32), dists[0].astype(self.dtype)
+			if simFunc == self.euclideanDist:
+				dists = np.sqrt(dists)
+			if simFunc == self.cosineSim:
+				dists = 1 - dists
+			return ids, Y[ids], dists
 		vInfo = []
 		D = len(qVec)
 		N = len(Y)
@@ -74,7 +74,7 @@ for lK in lK_list:
 	#print ids
 	found = [0]*len(R)
 	for qi in range(Q):
-		ids, neighbors, dists = pq.knnes(X,qV[qi],pq.N,pq.euclideanDistSqr);
+		ids, neighbors, dists = pq.knnes(X,qV[qi],max(R),pq.euclideanDistSqr);
 		#print 'neighbors:',ids,'-',neighbors,'-',dists
 		#for ii in range(10):
 			#print 'ids[:ii*10]-',ii+1,ids[:ii*10+10]
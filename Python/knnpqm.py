@@ -74,13 +74,13 @@ for lM in lM_list:
 	#print ids
 	found = [0]*len(R)
 	for qi in range(Q):
-		ids, neighbors, dists = pq.KNNES(X,qV[qi],pq.N,pq.euclideanDistSqr);
+		ids, neighbors, dists = pq.knnes(X,qV[qi],max(R),pq.euclideanDistSqr);
 		#print 'neighbors:',ids,'-',neighbors,'-',dists
 		#for ii in range(10):
 			#print 'ids[:ii*10]-',ii+1,ids[:ii*10+10]
 
 		#indicators, isum, kmax = pq.query(qV[qi], 1)
-		indicators, indc_, dists_, iOR, iSum, kmax = pq.query(qV[qi], 1, kc)
+		dists_, iOR, iSum, kmax = pq.query(qV[qi], 1, kc)
 		for i in range(len(R)):
 			if kmax[0] in ids[:R[i]]:
 				print '.',
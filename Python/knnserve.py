@@ -0,0 +1,267 @@
+import numpy as np
+import SocketServer
+import threading
+import Queue
+import socket
+import struct
+import collections
+import argparse
+import time
+import os
+import knnstore
+
+"""
+Local query server over a loaded index (knnpq.PQ, knnhpq.HPQ or knnivf.IVFPQ), on a TCP or Unix socket.
+Connection handlers only parse requests; a single dispatcher thread coalesces the queries waiting in the
+queue into micro-batches of at most maxBatch queries, waiting at most maxWait seconds after the first one,
+and answers each batch with one call to the index's search_batch.
+
+Binary protocol, little endian, any number of requests per connection:
+	request : k (uint32), D (uint32), then the D float32 components of the query vector
+	response: n (uint32), then n int64 ids and n float32 distances of the nearest vectors, nearest first
+	error   : n = ERROR, then the length (uint32) and utf-8 text of the message; the connection stays usable
+"""
+
+REQUEST  = struct.Struct('<II')
+RESPONSE = struct.Struct('<I')
+ERROR    = 0xFFFFFFFF # response count of an error response
+WINDOW   = 2**16 # number of latest queries kept for the latency statistics
+
+# read exactly n bytes from the socket; returns None if the peer closed the connection first
+def recvall(sock, n):
+	buf = bytearray(n)
+	view = memoryview(buf)
+	while n:
+		r = sock.recv_into(view, n)
+		if r == 0:
+			return None
+		view = view[r:]
+		n -= r
+	return buf
+
+# p50 / p99 latencies in milliseconds of the latency samples lat (seconds)
+def percentiles(lat):
+	if not len(lat):
+		return {'p50': None, 'p99': None}
+	p50, p99 = np.percentile(np.asarray(lat)*1e3, [50, 99])
+	return {'p50': p50, 'p99': p99}
+
+class Batcher(object):
+
+	# start the dispatcher thread serving index; kwargs go to the index's search_batch (e.g. rerank, w, nprobe)
+	def __init__(self, index, maxBatch=64, maxWait=0.002, **kwargs):
+		assert maxBatch >= 1, 'micro-batches hold at least one query'
+		self.index = index
+		self.maxBatch = maxBatch
+		self.maxWait = maxWait
+		self.kwargs = kwargs
+		self.queue = Queue.Queue()
+		self.lat = collections.deque(maxlen=WINDOW) # enqueue to answer latency of every query
+		self.sizes = collections.deque(maxlen=WINDOW) # size of every micro-batch
+		self.count = 0
+		self.start = time.time()
+		self.thread = threading.Thread(target=self.run)
+		self.thread.daemon = True
+		self.thread.start()
+
+	# queue one query and block until its micro-batch is answered; returns its ids and distances
+	def search(self, qvec, k):
+		item = [qvec, k, time.time(), threading.Event(), None]
+		self.queue.put(item)
+		item[3].wait()
+		if isinstance(item[4], Exception):
+			raise item[4]
+		return item[4]
+
+	# dispatcher loop: take the first waiting query, fill the micro-batch until it is full or maxWait has passed
+	def run(self):
+		while True:
+			first = self.queue.get()
+			if first is None:
+				return
+			batch = [first]
+			deadline = time.time() + self.maxWait
+			while len(batch) < self.maxBatch:
+				try:
+					item = self.queue.get(timeout=max(0, deadline - time.time()))
+				except Queue.Empty:
+					break
+				if item is None:
+					self.queue.put(None)
+					break
+				batch.append(item)
+			self.dispatch(batch)
+
+	# answer a micro-batch with one search_batch at the largest k asked, then wake its queries
+	# a failed search is handed to every query of the batch, to be raised in its own thread
+	def dispatch(self, batch):
+		try:
+			Q = np.array([item[0] for item in batch], dtype=self.index.dtype)
+			ids, dists = self.index.search_batch(Q, max(item[1] for item in batch), **self.kwargs)
+		except Exception as e:
+			for item in batch:
+				item[4] = e
+				item[3].set()
+			return
+		now = time.time()
+		for q, item in enumerate(batch):
+			n = np.count_nonzero(ids[q, :item[1]] >= 0)
+			item[4] = ids[q, :n], dists[q, :n]
+			self.lat.append(now - item[2])
+			item[3].set()
+		self.sizes.append(len(batch))
+		self.count += len(batch)
+
+	# served queries, QPS since start, latency percentiles and mean micro-batch size
+	def stats(self):
+		stats = percentiles(list(self.lat))
+		stats['queries'] = self.count
+		stats['qps'] = self.count / (time.time() - self.start)
+		stats['batch'] = np.mean(self.sizes) if len(self.sizes) else None
+		return stats
+
+	def close(self):
+		self.queue.put(None)
+		self.thread.join()
+
+class Handler(SocketServer.BaseRequestHandler):
+
+	# serve requests on one connection until the client closes it; a request that fails is answered
+	# with an error response and the connection goes on
+	def handle(self):
+		batcher = self.server.batcher
+		while True:
+			head = recvall(self.request, REQUEST.size)
+			if head is None:
+				return
+			k, D = REQUEST.unpack(head)
+			body = recvall(self.request, 4*D)
+			if body is None:
+				return
+			if D != batcher.index.D:
+				self.error('query vectors should be '+str(batcher.index.D)+'-dimensional, not '+str(D))
+				continue
+			try:
+				ids, dists = batcher.search(np.frombuffer(body, dtype='<f4'), k)
+			except Exception as e:
+				self.error(repr(e))
+				continue
+			self.request.sendall(RESPONSE.pack(len(ids)) + ids.astype('<i8').tobytes() + dists.astype('<f4').tobytes())
+
+	# send an error response with the message msg
+	def error(self, msg):
+		msg = msg.encode('utf-8')
+		self.request.sendall(RESPONSE.pack(ERROR) + RESPONSE.pack(len(msg)) + msg)
+
+class TCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+class UnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+	daemon_threads = True
+
+# create a server for index on address: a (host, port) pair for TCP or a path for a Unix socket
+# call serve_forever() to run it, or serve_forever in a thread for an in-process server
+def server(index, address, maxBatch=64, maxWait=0.002, **kwargs):
+	if isinstance(address, tuple):
+		srv = TCPServer(address, Handler)
+	else:
+		if os.path.exists(address):
+			os.remove(address)
+		srv = UnixServer(address, Handler)
+	srv.batcher = Batcher(index, maxBatch, maxWait, **kwargs)
+	return srv
+
+class Client(object):
+
+	# connect to a server on address: a (host, port) pair for TCP or a path for a Unix socket
+	def __init__(self, address):
+		if isinstance(address, tuple):
+			self.sock = socket.create_connection(address)
+			self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		else:
+			self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			self.sock.connect(address)
+
+	# k nearest neighbors of qvec; returns their ids and distances
+	# raises RuntimeError with the server's message when the server answers with an error, IOError when it closes the connection
+	def search(self, qvec, k):
+		qvec = np.asarray(qvec, dtype='<f4')
+		self.sock.sendall(REQUEST.pack(k, len(qvec)) + qvec.tobytes())
+		n, = RESPONSE.unpack(self.recv(RESPONSE.size))
+		if n == ERROR:
+			size, = RESPONSE.unpack(self.recv(RESPONSE.size))
+			raise RuntimeError('server error: '+bytes(self.recv(size)).decode('utf-8'))
+		body = self.recv(12*n)
+		return np.frombuffer(body, dtype='<i8', count=n), np.frombuffer(body, dtype='<f4', offset=8*n, count=n)
+
+	# read exactly n bytes of a response
+	def recv(self, n):
+		buf = recvall(self.sock, n)
+		if buf is None:
+			raise IOError('the server closed the connection')
+		return buf
+
+	def close(self):
+		self.sock.close()
+
+# load generator: clients concurrent connections send the queries Q round-robin, each waiting for its answer
+# before sending the next one; returns the client side QPS and latency percentiles
+def loadgen(address, Q, k, clients=16, queries=None):
+	queries = queries if queries is not None else len(Q)
+	lat = [[] for c in range(clients)]
+	def run(c):
+		cl = Client(address)
+		for q in range(c, queries, clients):
+			t = time.time()
+			cl.search(Q[q % len(Q)], k)
+			lat[c].append(time.time() - t)
+		cl.close()
+	threads = [threading.Thread(target=run, args=(c,)) for c in range(clients)]
+	t = time.time()
+	for th in threads:
+		th.start()
+	for th in threads:
+		th.join()
+	t = time.time() - t
+	stats = percentiles(sum(lat, []))
+	stats['queries'] = queries
+	stats['qps'] = queries / t
+	return stats
+
+# parse host:port into a TCP address, anything else is a Unix socket path
+def address(s):
+	host, sep, port = s.rpartition(':')
+	return (host or 'localhost', int(port)) if sep and port.isdigit() else s
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Serve an index over a socket, or generate load against a running server')
+	parser.add_argument('address', help='host:port for TCP or a path for a Unix socket')
+	parser.add_argument('--index', help='index file to serve (see knnstore); without it, run the load generator against address')
+	parser.add_argument('--max-batch', type=int, default=64, help='largest micro-batch')
+	parser.add_argument('--max-wait', type=float, default=0.002, help='longest wait in seconds for a micro-batch to fill')
+	parser.add_argument('--k', type=int, default=10, help='nearest neighbors per query (load generator)')
+	parser.add_argument('--clients', type=int, default=16, help='concurrent connections (load generator)')
+	parser.add_argument('--queries', type=int, default=10000, help='number of queries (load generator)')
+	parser.add_argument('--dim', type=int, default=64, help='dimension of the random query vectors (load generator)')
+	parser.add_argument('--report', type=float, default=10, help='seconds between statistics reports (server)')
+	args = parser.parse_args()
+
+	if args.index:
+		srv = server(knnstore.open_index(args.index), address(args.address), args.max_batch, args.max_wait)
+		def report():
+			while True:
+				time.sleep(args.report)
+				print srv.batcher.stats()
+		reporter = threading.Thread(target=report)
+		reporter.daemon = True
+		reporter.start()
+		print 'serving', args.index, 'on', args.address
+		try:
+			srv.serve_forever()
+		except KeyboardInterrupt:
+			pass
+		print srv.batcher.stats()
+	else:
+		Q = np.random.random((min(args.queries, 2**12), args.dim)).astype(np.float32)
+		print loadgen(address(args.address), Q, args.k, args.clients, args.queries)
@@ -0,0 +1,213 @@
+import numpy as np
+from multiprocessing import Process, Pipe
+import heapq
+import itertools
+import time
+import knnpq
+
+"""
+S  : the number of shards; shard s holds the database vectors lo[s] <= id < lo[s+1] in a worker process
+Cc : codebooks, trained once on the whole database (or a sample of it) and shared by all the shards
+metric: distance ranked by the search, 'l2', 'ip' or 'cos' (see knnpq.METRICS)
+
+Every shard is a knnpq.PQ over its own vectors with the shared codebooks, so the approximate distances
+of all the shards are comparable and the global top-k is the merge of the per-shard top-k lists.
+"""
+
+# build a shard PQ over the vectors Y with the trained codebooks Cc: encode, group and keep the raw vectors if rtype
+def _shard(Y, Cc, rtype, metric, verbose):
+	pq = knnpq.PQ(N=len(Y), D=Y.shape[1], M=Cc.shape[0], Kt=Cc.shape[1], dtype=Y.dtype.type, readcsv=False, writecsv=False, verbose=verbose, rtype=rtype, metric=metric)
+	pq.Cc[:] = Cc
+	pq.qvec_(Y, out=pq.Yt)
+	pq.ilists()
+	if pq.X is not None:
+		pq.X[:] = Y
+	return pq
+
+# worker process of one shard: build the shard (Y is inherited from the parent on fork), report ready, then
+# run the (method, args, kwargs) requests received on conn on the shard PQ until None arrives.
+# a failed request sends back its exception, to be raised in the parent
+def _serve(conn, Y, Cc, rtype, metric, verbose):
+	try:
+		t = time.time()
+		pq = _shard(Y, Cc, rtype, metric, verbose)
+		conn.send((time.time() - t, pq.memory()))
+	except Exception as e:
+		conn.send(e)
+		return
+	del Y
+	while True:
+		req = conn.recv()
+		if req is None:
+			break
+		name, args, kwargs = req
+		try:
+			conn.send(getattr(pq, name)(*args, **kwargs))
+		except Exception as e:
+			conn.send(e)
+	conn.close()
+
+# k-way heap merge of the per-shard top-k lists of one query, each sorted by distance; returns the k nearest ids and distances
+def merge(ids, dists, k):
+	top = list(itertools.islice(heapq.merge(*[zip(d, i) for i, d in zip(ids, dists)]), k))
+	return np.array([i for _, i in top], dtype=np.intp), np.array([d for d, _ in top], dtype=dists[0].dtype)
+
+class ShardedPQ(object):
+
+	# initialize the sharded index: N vectors in S shards of N/S (the last one takes the remainder)
+	def __init__(self, N, D, M, Kt, S, dtype=np.float32, rtype=None, verbose=False, metric='l2'):
+		# parameter checks
+		assert D % M == 0, 'equally divided sub-spaces are required; make sure M divides D'
+		assert 0 < Kt <= 2 ** 32, 'codebook should be smaller than 2**32'
+		assert 0 < S and Kt <= N / S, 'every shard should hold at least Kt vectors'
+		assert metric in knnpq.METRICS, 'metric should be one of '+', '.join(knnpq.METRICS)
+		# assign parameters
+		self.N = N
+		self.D = D
+		self.M = M
+		self.Dt = D/M
+		self.Kt = Kt
+		self.S = S
+		self.dtype = dtype
+		self.rtype = rtype
+		self.metric = metric
+		self.verbose = verbose
+
+		self.lo = np.array([s * (N / S) for s in range(S)] + [N], dtype=np.int64) # first id of every shard
+		self.Cc = np.zeros((self.M, self.Kt, self.Dt), dtype=self.dtype)
+		self.conns = []
+		self.procs = []
+		if verbose:
+			print 'ShardedPQ class parameters: N:',N,', D:',D,', M:',M,', Dt:',self.Dt,', Kt: ',Kt,', S:',S
+
+	##########################################
+
+	# construct the sharded index: train the shared codebooks, the subspaces on a pool of workers processes (S by default),
+	# then build all the shards at once, one process each
+	# kmcSample / kmcBatch train every k-means on a sample / with mini-batches of that many vectors (see knnpq.kmeans)
+	def construct(self, Y, kmcIter=20,kmcSeed=7, kmcSample=None, kmcBatch=None, workers=None):
+		# checks on vectors DB
+		assert Y.ndim     == 2         , 'Vectors database should be a two dimensional matrix'
+		assert Y.shape[0] == self.N    , 'Vectors database should have N vectors'
+		assert Y.shape[1] == self.D    , 'Vectors in database should be D-dimensional'
+		assert Y.dtype    == self.dtype, 'Vector type should be self.dtype'
+		assert not self.procs, 'the shards are already built'
+
+		self.timings = {'kmeans': 0.0, 'shards': 0.0}
+		if self.metric == 'cos':
+			Y = knnpq.normalize(Y)
+		workers = self.S if workers is None else workers
+		t = time.time()
+		# the same per-subspace training as knnpq.PQ.construct, without encoding: the shards encode their own vectors
+		self.Cc[:] = knnpq.train_codebooks(Y, self.M, self.Kt, kmcIter, kmcSeed, kmcSample, kmcBatch, workers, 'process', verbose=self.verbose)
+		self.timings['kmeans'] += time.time() - t
+
+		t = time.time()
+		for s in range(self.S):
+			conn, child = Pipe()
+			p = Process(target=_serve, args=(child, Y[self.lo[s]:self.lo[s+1]], self.Cc, self.rtype, self.metric, self.verbose))
+			p.daemon = True
+			p.start()
+			child.close()
+			self.conns.append(conn)
+			self.procs.append(p)
+		# every shard reports its build time and memory once it is ready
+		built = self.gather()
+		self.shard_timings = [b[0] for b in built]
+		self.shard_memory = [b[1] for b in built]
+		self.timings['shards'] += time.time() - t
+		if self.verbose:
+			print 'ShardedPQ build timings (s):', self.timings
+		return self
+
+	# receive one reply from every shard, in shard order; re-raises the first exception a shard sent back
+	def gather(self, shards=None):
+		replies = [self.conns[s].recv() for s in (range(self.S) if shards is None else shards)]
+		for r in replies:
+			if isinstance(r, Exception):
+				raise r
+		return replies
+
+	# run the shard PQ method name on the shards (all of them by default, or only those given), in parallel
+	def scatter(self, name, args, kwargs, shards=None):
+		shards = range(self.S) if shards is None else shards
+		for s in shards:
+			self.conns[s].send((name, args[s] if isinstance(args, dict) else args, kwargs))
+		return self.gather(shards)
+
+	# split the global ids sidx into the local ids of every shard; shards with no ids are left out
+	def split(self, sidx):
+		sidx = np.sort(np.asarray(sidx))
+		cut = np.searchsorted(sidx, self.lo)
+		return dict((s, sidx[cut[s]:cut[s+1]] - self.lo[s]) for s in range(self.S) if cut[s+1] > cut[s])
+
+	# k nearest neighbors of qvec over all the shards (among the ids sidx if given, see knnpq.PQ.search)
+	# rerank > 0 reranks a shortlist of rerank vectors in every shard, so S*rerank candidates in all
+	def search(self, qvec, k, sidx=None, rerank=0):
+		qvec = np.asarray(qvec, dtype=self.dtype)
+		if sidx is None:
+			res = self.scatter('search', (qvec, k), {'rerank': rerank})
+			shards = range(self.S)
+		else:
+			sel = self.split(sidx)
+			shards = sorted(sel)
+			if not shards:
+				return np.zeros((0), dtype=np.intp), np.zeros((0), dtype=self.dtype)
+			res = self.scatter('search', dict((s, (qvec, k, sel[s])) for s in shards), {'rerank': rerank}, shards)
+		return merge([ids + self.lo[s] for s, (ids, _) in zip(shards, res)], [dists for ids, dists in res], k)
+
+	# batched k nearest neighbors of the query vectors Q (nq,D) over all the shards (see knnpq.PQ.search_batch)
+	# returns (nq,k) ids and distances, padded with -1 / inf; the per-shard lists are merged at once with a
+	# partial sort of their concatenation, which selects the same k as merging every query's lists one by one
+	def search_batch(self, Q, k, sidx=None, rerank=0):
+		Q = np.asarray(Q, dtype=self.dtype)
+		if sidx is None:
+			shards = range(self.S)
+			res = self.scatter('search_batch', (Q, k), {'rerank': rerank})
+		else:
+			sel = self.split(sidx)
+			shards = sorted(sel)
+			res = self.scatter('search_batch', dict((s, (Q, k, sel[s])) for s in shards), {'rerank': rerank}, shards)
+		ids   = np.full((len(Q), k), -1    , dtype=np.intp  )
+		dists = np.full((len(Q), k), np.inf, dtype=self.dtype)
+		if not shards:
+			return ids, dists
+		I = np.concatenate([np.where(i >= 0, i + self.lo[s], -1) for s, (i, _) in zip(shards, res)], axis=1)
+		D = np.concatenate([d for _, d in res], axis=1)
+		sel = knnpq.topk(D, min(k, D.shape[1]))
+		D = np.take_along_axis(D, sel, axis=1)
+		order = np.argsort(D, axis=1, kind='mergesort')
+		ids[:, :sel.shape[1]]   = np.take_along_axis(np.take_along_axis(I, sel, axis=1), order, axis=1)
+		dists[:, :sel.shape[1]] = np.take_along_axis(D, order, axis=1)
+		return ids, dists
+
+	# KNN-PQ-ES query over all the shards
+	def knnpqes(self, qvec, k, rerank=0):
+		kmax,_ = self.search(qvec, k, rerank=rerank)
+		return kmax
+
+	# memory footprint of the index structures in bytes: the shared codebooks once, the rest summed over the shards
+	def memory(self):
+		mem = {}
+		for m in self.shard_memory:
+			for name, n in m.items():
+				mem[name] = mem.get(name, 0) + n
+		mem['Cc'] = self.Cc.nbytes
+		return mem
+
+	# stop the shard processes
+	def close(self):
+		for conn in self.conns:
+			conn.send(None)
+			conn.close()
+		for p in self.procs:
+			p.join()
+		self.conns = []
+		self.procs = []
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+		return False
@@ -0,0 +1,95 @@
+import numpy as np
+import os
+import time
+import tempfile
+import knnstore
+
+"""
+Index shared by many processes on one machine: the index is published as a knnstore file into a shared
+directory (a tmpfs such as /dev/shm by default), and every reader process maps it read-only with
+mmap='r', so all of them share one copy of its pages through the page cache instead of each loading its own.
+
+Directory layout:
+	index-<g>.bin : the index of generation g, written by knnstore.save, which renames it into place complete
+	generation    : 8 bytes, the uint64 generation of the current index, mapped by every reader; it is bumped
+	                only after the file of the new generation is in place, so a reader that sees g can open it
+Older generations are unlinked once keep newer ones exist; readers still mapping them keep their pages until they refresh.
+"""
+
+SHM = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+# shared directory of the index name
+def directory(name):
+	return os.path.join(SHM, name)
+
+# memory-mapped generation counter of the shared directory path, created as 0 if missing
+def _generation(path, mode):
+	fn = os.path.join(path, 'generation')
+	if mode == 'r+' and not os.path.exists(fn):
+		np.zeros((1), dtype=np.uint64).tofile(fn + '.tmp')
+		os.rename(fn + '.tmp', fn)
+	return np.memmap(fn, dtype=np.uint64, mode=mode, shape=(1,))
+
+class Publisher(object):
+
+	# publisher of the indexes of the shared directory path, keeping the files of the keep latest generations
+	def __init__(self, path, keep=2):
+		assert keep >= 1, 'the current generation is always kept'
+		if not os.path.isdir(path):
+			os.makedirs(path)
+		self.path = path
+		self.keep = keep
+		self.gen = _generation(path, 'r+')
+
+	# publish a built index (any index with save(fn), e.g. knnpq.PQ, knnhpq.HPQ, knnivf.IVFPQ) as the next generation
+	# readers switch to it on their next refresh; returns the new generation
+	def publish(self, index):
+		g = int(self.gen[0]) + 1
+		index.save(os.path.join(self.path, 'index-'+str(g)+'.bin'))
+		self.gen[0] = g
+		self.gen.flush()
+		for old in range(g - self.keep, 0, -1):
+			fn = os.path.join(self.path, 'index-'+str(old)+'.bin')
+			if not os.path.exists(fn):
+				break
+			os.remove(fn)
+		return g
+
+class Reader(object):
+
+	# reader of the shared directory path; waits up to timeout seconds for a first index to be published
+	def __init__(self, path, timeout=0):
+		self.path = path
+		self.index = None
+		self.generation = 0
+		t = time.time()
+		while not os.path.exists(os.path.join(path, 'generation')) or not self.refresh():
+			assert time.time() - t < timeout, 'no index is published in '+path
+			time.sleep(0.01)
+
+	# map the current generation read-only if it changed since the last refresh; returns whether it did
+	# the counter is mapped, so checking it costs a memory read and refresh can be called before every query
+	def refresh(self):
+		if not hasattr(self, 'gen'):
+			self.gen = _generation(self.path, 'r')
+		while True:
+			g = int(self.gen[0])
+			if g == self.generation:
+				return False
+			try:
+				self.index = knnstore.open_index(os.path.join(self.path, 'index-'+str(g)+'.bin'), mmap='r')
+			except (IOError, OSError):
+				# the publisher moved on and removed generation g in the meantime; read the counter again
+				continue
+			self.generation = g
+			return True
+
+	# search the current index (see its search); refreshes first
+	def search(self, qvec, k, **kwargs):
+		self.refresh()
+		return self.index.search(qvec, k, **kwargs)
+
+	# batched search of the current index (see its search_batch); refreshes first
+	def search_batch(self, Q, k, **kwargs):
+		self.refresh()
+		return self.index.search_batch(Q, k, **kwargs)
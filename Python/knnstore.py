@@ -0,0 +1,132 @@
+import numpy as np
+import json
+import struct
+import os
+import mmap
+import ctypes
+
+"""
+Binary index file format
+	magic   : 8 bytes, 'KNNPQIDX'
+	version : uint32, little endian
+	hlen    : uint32, little endian, length of the header
+	header  : hlen bytes of utf-8 JSON: {'class': ..., 'params': {...}, 'arrays': {name: {'dtype', 'shape', 'offset'}}}
+	arrays  : raw C-ordered array data, each starting at a multiple of ALIGN bytes from the file start
+Arrays are stored with their exact dtypes, so loading is a plain read or an mmap of the file
+"""
+
+MAGIC   = b'KNNPQIDX'
+VERSION = 1
+ALIGN   = 64 # alignment of every array in the file, in bytes
+
+def _align(n):
+	return (n + ALIGN - 1) // ALIGN * ALIGN
+
+# header of a file holding arrays with the given specs {name: (dtype, shape)}
+# returns the padded header, the array layout {name: {'dtype', 'shape', 'offset'}} and the file size
+def _layout(cls, params, specs):
+	names = sorted(specs)
+	meta = {}
+	for name in names:
+		dtype, shape = specs[name]
+		meta[name] = {'dtype': np.dtype(dtype).str, 'shape': [int(n) for n in shape], 'offset': 0}
+	# offsets depend on the header length and the header holds the offsets: size the header with
+	# placeholder offsets wide enough for any file size, then fill in the real ones
+	for name in names:
+		meta[name]['offset'] = 2**62
+	hlen = len(json.dumps({'class': cls, 'params': params, 'arrays': meta}).encode('utf-8'))
+	offset = _align(16 + hlen)
+	for name in names:
+		meta[name]['offset'] = offset
+		offset = _align(offset + np.dtype(specs[name][0]).itemsize * int(np.prod(specs[name][1])))
+	header = json.dumps({'class': cls, 'params': params, 'arrays': meta}).encode('utf-8')
+	header += b' ' * (hlen - len(header))
+	return struct.pack('<8sII', MAGIC, VERSION, hlen) + header, meta, offset
+
+# write the arrays dict {name: ndarray} with the JSON-serializable params under index class cls to file fn
+# the file is written next to fn and renamed over it, so readers never see a partially written index
+def save(fn, cls, params, arrays):
+	header, meta, size = _layout(cls, params, dict((name, (a.dtype, a.shape)) for name, a in arrays.items()))
+	tmp = fn + '.tmp'
+	with open(tmp, 'wb') as f:
+		f.write(header)
+		for name in sorted(arrays):
+			f.seek(meta[name]['offset'])
+			np.ascontiguousarray(arrays[name]).tofile(f)
+		f.truncate(size)
+	os.rename(tmp, fn)
+
+# create an index file fn with zero-filled arrays of the given specs {name: (dtype, shape)} and return
+# them as read-write np.memmap views, so an index can be built straight into its file
+def create(fn, cls, params, specs):
+	header, meta, size = _layout(cls, params, specs)
+	with open(fn, 'wb') as f:
+		f.write(header)
+		f.truncate(size)
+	return load(fn, mmap='r+')[2]
+
+# read an index file; returns (cls, params, arrays)
+# mmap: None reads every array into memory, otherwise the arrays are np.memmap views opened with this
+# mode ('r' read-only, 'r+' read-write, 'c' copy-on-write)
+def load(fn, mmap=None):
+	with open(fn, 'rb') as f:
+		header = _header(f, fn)
+		arrays = {}
+		for name, a in header['arrays'].items():
+			dtype, shape = np.dtype(str(a['dtype'])), tuple(a['shape'])
+			if mmap is not None:
+				if np.prod(shape) == 0:
+					arrays[name] = np.zeros(shape, dtype=dtype)
+				else:
+					arrays[name] = np.memmap(fn, dtype=dtype, mode=mmap, offset=a['offset'], shape=shape)
+			else:
+				f.seek(a['offset'])
+				arrays[name] = np.fromfile(f, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+	return header['class'], header['params'], arrays
+
+# the JSON header of the index file open as f, read from its start; leaves f after the header
+def _header(f, fn):
+	magic, version, hlen = struct.unpack('<8sII', f.read(16))
+	assert magic == MAGIC, fn+' is not an index file'
+	assert version <= VERSION, 'index file version '+str(version)+' is newer than this reader'
+	return json.loads(f.read(hlen).decode('utf-8'))
+
+# the index class name and params of the index file fn, read from its header only
+def header(fn):
+	with open(fn, 'rb') as f:
+		h = _header(f, fn)
+	return h['class'], h['params']
+
+# load an index file of any class: the class named in the header loads it (see load for mmap)
+def open_index(fn, mmap='r'):
+	# the index modules import this one, so they are imported here rather than at the top
+	import knnpq, knnhpq, knnivf
+	name,_ = header(fn)
+	classes = {'PQ': knnpq.PQ, 'HPQ': knnhpq.HPQ, 'IVFPQ': knnivf.IVFPQ}
+	assert name in classes, fn+' holds an unknown index class '+name
+	return classes[name].load(fn, mmap=mmap)
+
+MADV_WILLNEED = 3 # madvise advice to read pages ahead, the same value on Linux and the BSDs / macOS
+
+# madvise of the C library, called through ctypes since the mmap module only has it from Python 3.8; None where there is none
+try:
+	_madvise = ctypes.CDLL(None, use_errno=True).madvise
+	_madvise.argtypes = (ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int)
+	_madvise.restype = ctypes.c_int
+except (OSError, AttributeError, TypeError):
+	_madvise = None
+
+# hint the kernel to read ahead rows [start, stop) of the memory-mapped array a; sequential
+# block scans call it for the next block while they work on the current one. a no-op for
+# in-memory arrays and on platforms without madvise; returns whether the hint was given
+def advise(a, start, stop):
+	if _madvise is None or getattr(a, '_mmap', None) is None:
+		return False
+	start, stop = max(start, 0), min(stop, a.shape[0])
+	if stop <= start:
+		return False
+	# madvise takes a page-aligned address range
+	lo = a.ctypes.data + start * a.strides[0]
+	hi = a.ctypes.data + stop * a.strides[0]
+	lo -= lo % mmap.PAGESIZE
+	return _madvise(lo, hi - lo, MADV_WILLNEED) == 0